@@ -0,0 +1,88 @@
+"""Pipeline construction and run start costs as the pipelines grow"""
+from shed.translation import (
+    DBFriendly,
+    _merkle_cache,
+    get_env_data,
+    merkle_hash,
+)
+
+from .documents import SyntheticRun
+from .pipelines import VARIANTS, build_pipeline
+
+SIZES = [10, 100, 1000, 5000]
+# (fan out, fan in)
+SHAPES = ["1-1", "2-1", "4-2"]
+
+
+def _shape(shape):
+    fan_out, fan_in = shape.split("-")
+    return int(fan_out), int(fan_in)
+
+
+class Construction(object):
+    params = (SIZES, SHAPES, list(VARIANTS))
+    param_names = ["n_nodes", "fan_out-fan_in", "variant"]
+    timeout = 300
+
+    def time_build(self, n_nodes, shape, variant):
+        build_pipeline(n_nodes, *_shape(shape), variant=variant)
+
+    def peakmem_build(self, n_nodes, shape, variant):
+        build_pipeline(n_nodes, *_shape(shape), variant=variant)
+
+
+class StartDocument(object):
+    """The cost of starting a run through a pipeline with provenance"""
+
+    params = (SIZES, SHAPES)
+    param_names = ["n_nodes", "fan_out-fan_in"]
+    timeout = 300
+
+    def setup(self, n_nodes, shape):
+        self.source, self.outputs = build_pipeline(n_nodes, *_shape(shape))
+        self.starts = []
+        for o in self.outputs:
+            o.DBFriendly().sink(self.starts.append)
+        raw_starts = self.outputs[-1].sink_to_list()
+        self.run = SyntheticRun(n_events=0)
+        # warm up the caches (env capture, merkle hash, DBFriendly)
+        self.start_stop()
+        self.start = raw_starts[0][1]
+        del self.starts[:]
+
+    def start_stop(self):
+        docs = list(self.run)
+        self.source.emit(docs[0])
+        self.source.emit(docs[-1])
+
+    def time_start_document(self, n_nodes, shape):
+        """Start (and stop) a run through the warm pipeline"""
+        self.start_stop()
+        del self.starts[:]
+
+    def peakmem_start_document(self, n_nodes, shape):
+        self.start_stop()
+        del self.starts[:]
+
+    def time_merkle_hash(self, n_nodes, shape):
+        """Hash the graph of every output from scratch"""
+        _merkle_cache.clear()
+        for o in self.outputs:
+            merkle_hash(o)
+
+    def time_db_friendly(self, n_nodes, shape):
+        """Serialize the graph of one output from scratch"""
+        DBFriendly(None).update(("start", self.start))
+
+
+class EnvCapture(object):
+    timeout = 300
+
+    def setup(self):
+        get_env_data()
+
+    def time_capture(self):
+        get_env_data(refresh=True)
+
+    def time_cached(self):
+        get_env_data()
@@ -0,0 +1,92 @@
+"""Synthetic document streams, so the benchmarks don't need a RunEngine"""
+import time
+from uuid import uuid4
+
+import numpy as np
+from event_model import compose_run
+
+
+class SyntheticRun(object):
+    """A run's worth of documents
+
+    The descriptors and events are made once, each iteration yields them
+    between a new start and stop document so the same run can be pushed
+    through stateful nodes over and over.
+
+    Parameters
+    ----------
+    n_events : int, optional
+        Number of events per descriptor, defaults to 100
+    n_keys : int, optional
+        Number of data keys in each event, named ``det_0``, ``det_1``...,
+        defaults to 1
+    frame_shape : tuple, optional
+        Shape of the data, ``()`` for scalars, defaults to ``()``
+    n_descriptors : int, optional
+        Number of descriptors (event streams) in the run, the first is
+        named ``primary``. The events of the streams are interleaved.
+        Defaults to 1
+    rate : float, optional
+        Events per second per descriptor, used for the event times.
+        Defaults to 10
+    """
+
+    def __init__(
+        self,
+        n_events=100,
+        n_keys=1,
+        frame_shape=(),
+        n_descriptors=1,
+        rate=10.0,
+    ):
+        self.n_events = n_events
+        self.keys = [f"det_{i}" for i in range(n_keys)]
+        t0 = time.time()
+        start, compose_descriptor, _, compose_stop = compose_run(
+            time=t0, metadata={"synthetic": True}
+        )
+        self.start = start
+        data_keys = {
+            k: {
+                "source": "synthetic",
+                "dtype": "array" if frame_shape else "number",
+                "shape": list(frame_shape),
+            }
+            for k in self.keys
+        }
+        frame = np.ones(frame_shape)
+        streams = []
+        for i in range(n_descriptors):
+            descriptor, compose_event, _ = compose_descriptor(
+                data_keys=data_keys,
+                name="primary" if i == 0 else f"stream_{i}",
+                time=t0,
+                validate=False,
+            )
+            streams.append(
+                (
+                    descriptor,
+                    [
+                        compose_event(
+                            data={k: frame * j for k in self.keys},
+                            timestamps={k: t0 + j / rate for k in self.keys},
+                            time=t0 + j / rate,
+                            validate=False,
+                        )
+                        for j in range(n_events)
+                    ],
+                )
+            )
+        self.docs = [("descriptor", d) for d, _ in streams]
+        for events in zip(*[events for _, events in streams]):
+            self.docs.extend(("event", e) for e in events)
+        self.stop = compose_stop(validate=False)
+
+    def __len__(self):
+        return len(self.docs) + 2
+
+    def __iter__(self):
+        uid = str(uuid4())
+        yield "start", dict(self.start, uid=uid)
+        yield from self.docs
+        yield "stop", dict(self.stop, uid=str(uuid4()), run_start=uid)
@@ -0,0 +1,69 @@
+"""Synthetic pipelines of configurable size and shape"""
+import operator as op
+
+from rapidz import Stream
+
+from shed.simple import SimpleFromEventStream, SimpleToEventStream
+from shed.translation import FromEventStream, ToEventStream
+
+VARIANTS = {
+    "simple": (SimpleFromEventStream, SimpleToEventStream),
+    "translation": (FromEventStream, ToEventStream),
+}
+
+
+def build_pipeline(n_nodes, fan_out=1, fan_in=1, variant="translation"):
+    """Build a pipeline of ``n_nodes`` processing nodes
+
+    The nodes form a tree under a single ``FromEventStream``, each node has
+    ``fan_out`` downstreams and every leaf gets a ``ToEventStream``. With
+    ``fan_in`` larger than one every node also zips in up to ``fan_in - 1``
+    earlier nodes (the zip and the map count as one node).
+
+    Parameters
+    ----------
+    n_nodes : int
+        The number of processing nodes (not counting the translation nodes)
+    fan_out : int, optional
+        Number of downstreams of each node, defaults to 1 (a chain)
+    fan_in : int, optional
+        Number of upstreams of each node, defaults to 1
+    variant : {"simple", "translation"}, optional
+        Which translation nodes to use, defaults to "translation"
+
+    Returns
+    -------
+    source : Stream
+        The source of the pipeline
+    outputs : list of Stream
+        The ``ToEventStream`` nodes
+    """
+    from_event_stream, to_event_stream = VARIANTS[variant]
+    source = Stream()
+    nodes = [
+        from_event_stream("event", ("data", "det_0"), source, principle=True)
+    ]
+    children = [0]
+    i = 0
+    while len(nodes) <= n_nodes:
+        parent = nodes[i // fan_out]
+        children[i // fan_out] += 1
+        # pull in earlier nodes, spread out over the pipeline
+        others = []
+        for j in range(1, fan_in):
+            other = nodes[(i * j) // fan_in]
+            if other is not parent and other not in others:
+                others.append(other)
+        if others:
+            node = parent.zip(*others).map(sum)
+        else:
+            node = parent.map(op.add, 1)
+        nodes.append(node)
+        children.append(0)
+        i += 1
+    outputs = [
+        to_event_stream(node, ("det",))
+        for node, n_children in zip(nodes[1:], children[1:])
+        if not n_children
+    ]
+    return source, outputs
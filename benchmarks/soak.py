@@ -0,0 +1,128 @@
+"""Push many runs through a pipeline and check memory use stays bounded
+
+Run as a script for the full soak (10**6 events by default)::
+
+    python -m benchmarks.soak --events 1000000
+
+or through asv, which runs a shorter soak and tracks the growth.
+"""
+import argparse
+import gc
+import operator as op
+import resource
+import sys
+import tempfile
+
+from rapidz import Stream
+
+from shed.writers import NpyWriter
+
+from .documents import SyntheticRun
+from .pipelines import VARIANTS
+
+
+def rss():
+    """The current resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # not linux, fall back to the peak
+        r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return r if sys.platform == "darwin" else r * 1024
+
+
+def build(variant, root):
+    """A pipeline with every kind of stateful node in it"""
+    from_event_stream, to_event_stream = VARIANTS[variant]
+    source = Stream()
+    router = source.RouteEventStreams()
+    fes = from_event_stream("event", ("data", "det_0"), router, principle=True)
+    tes = to_event_stream(fes.map(op.mul, 2), ("det",))
+    align = source.AlignEventStreams(tes)
+    last = tes.LastCache()
+    store = tes.Store(root, NpyWriter)
+    nodes = [router, fes, tes, align, last, store]
+    if variant == "translation":
+        nodes.append(tes.DBFriendly())
+    for n in nodes[3:]:
+        n.sink(lambda x: None)
+    return source, nodes
+
+
+def state_size(nodes):
+    return sum(sum(n.memory_usage().values()) for n in nodes)
+
+
+def soak(n_events=10 ** 6, events_per_run=1000, variant="translation"):
+    """Push ``n_events`` through a pipeline in runs of ``events_per_run``
+
+    Returns
+    -------
+    rss_growth : int
+        The growth in RSS (in bytes) between the end of the first tenth of
+        the runs and the end of the soak
+    state_growth : int
+        The growth in the state held by the nodes (as reported by
+        ``memory_usage``) between the end of the first and last runs
+    """
+    run = SyntheticRun(n_events=events_per_run)
+    n_runs = max(n_events // events_per_run, 10)
+    with tempfile.TemporaryDirectory() as root:
+        source, nodes = build(variant, root)
+        for i in range(n_runs):
+            for nd in run:
+                source.emit(nd)
+            if i == 0:
+                first_state = state_size(nodes)
+            if i == n_runs // 10:
+                gc.collect()
+                warm_rss = rss()
+        gc.collect()
+        return rss() - warm_rss, state_size(nodes) - first_state
+
+
+class Soak(object):
+    params = list(VARIANTS)
+    param_names = ["variant"]
+    timeout = 600
+
+    def track_rss_growth(self, variant):
+        return soak(10 ** 5, variant=variant)[0] / 2 ** 20
+
+    track_rss_growth.unit = "MiB"
+
+    def track_state_growth(self, variant):
+        return soak(10 ** 5, variant=variant)[1]
+
+    track_state_growth.unit = "bytes"
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--events", type=int, default=10 ** 6)
+    parser.add_argument("--events-per-run", type=int, default=1000)
+    parser.add_argument("--variant", choices=list(VARIANTS), default=None)
+    parser.add_argument(
+        "--max-rss-growth",
+        type=float,
+        default=50,
+        help="allowed RSS growth in MiB",
+    )
+    args = parser.parse_args(args)
+    ok = True
+    for variant in [args.variant] if args.variant else list(VARIANTS):
+        rss_growth, state_growth = soak(
+            args.events, args.events_per_run, variant
+        )
+        print(
+            f"{variant}: RSS grew {rss_growth / 2 ** 20:.1f} MiB, "
+            f"node state grew {state_growth} bytes"
+        )
+        ok &= rss_growth <= args.max_rss_growth * 2 ** 20
+        ok &= state_growth <= 0
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
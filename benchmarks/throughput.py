@@ -0,0 +1,117 @@
+"""Document throughput and per event latency through canonical pipelines
+
+Each benchmark is run for the ``simple`` and the ``translation`` (with
+provenance) nodes."""
+import operator as op
+import time
+
+from rapidz import Stream
+
+from .documents import SyntheticRun
+from .pipelines import VARIANTS
+
+
+def chain(variant, n_outputs=1, **kwargs):
+    """FromEventStream -> map -> ToEventStream, ``n_outputs`` times off of
+    the same FromEventStream"""
+    from_event_stream, to_event_stream = VARIANTS[variant]
+    source = Stream()
+    fes = from_event_stream(
+        "event", ("data", "det_0"), source, principle=True, **kwargs
+    )
+    outputs = [
+        to_event_stream(fes.map(op.mul, i), ("det",))
+        for i in range(n_outputs)
+    ]
+    return source, outputs
+
+
+def align(variant):
+    """The processed data merged back into the raw documents"""
+    source, (out,) = chain(variant)
+    return source, [source.AlignEventStreams(out)]
+
+
+def last_cache(variant):
+    source, (out,) = chain(variant)
+    return source, [out.LastCache()]
+
+
+PIPELINES = {
+    "chain": chain,
+    "fan_out": lambda variant: chain(variant, n_outputs=20),
+    "align": align,
+    "last_cache": last_cache,
+}
+
+
+class Throughput(object):
+    params = (
+        list(PIPELINES),
+        list(VARIANTS),
+        [(), (256, 256)],
+    )
+    param_names = ["pipeline", "variant", "frame_shape"]
+    timeout = 120
+
+    def setup(self, pipeline, variant, frame_shape):
+        self.run = SyntheticRun(n_events=200, frame_shape=frame_shape)
+        self.source, outputs = PIPELINES[pipeline](variant)
+        self.results = [o.sink_to_list() for o in outputs]
+        # one run to warm up any caches (eg the env capture)
+        self.emit_run()
+
+    def emit_run(self):
+        emit = self.source.emit
+        for nd in self.run:
+            emit(nd)
+        for r in self.results:
+            r.clear()
+
+    def time_run(self, pipeline, variant, frame_shape):
+        self.emit_run()
+
+    def track_documents_per_second(self, pipeline, variant, frame_shape):
+        t0 = time.perf_counter()
+        self.emit_run()
+        return len(self.run) / (time.perf_counter() - t0)
+
+    track_documents_per_second.unit = "documents/s"
+
+    def track_event_latency(self, pipeline, variant, frame_shape):
+        """The median time for an event to go through the pipeline"""
+        emit = self.source.emit
+        latencies = []
+        for name, doc in self.run:
+            t0 = time.perf_counter()
+            emit((name, doc))
+            if name == "event":
+                latencies.append(time.perf_counter() - t0)
+        for r in self.results:
+            r.clear()
+        latencies.sort()
+        return latencies[len(latencies) // 2] * 1e6
+
+    track_event_latency.unit = "us"
+
+
+class MultiDescriptorThroughput(object):
+    """Runs with many event streams and data keys, only one of which is
+    wanted"""
+
+    params = ([1, 10], list(VARIANTS))
+    param_names = ["n_descriptors", "variant"]
+
+    def setup(self, n_descriptors, variant):
+        self.run = SyntheticRun(
+            n_events=100, n_keys=10, n_descriptors=n_descriptors
+        )
+        self.source, outputs = chain(variant, event_stream_name="primary")
+        self.results = [o.sink_to_list() for o in outputs]
+
+    def time_run(self, n_descriptors, variant):
+        emit = self.source.emit
+        for nd in self.run:
+            emit(nd)
+        for r in self.results:
+            r.clear()
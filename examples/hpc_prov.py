@@ -34,16 +34,16 @@ RE.subscribe(lambda *x: source.emit(x))
 
 RE(bp.count([hw.motor1], 1))
 
-from shed.replay import replay
+from shed.replay import IncrementalReplay
 from rapidz.graph import _clean_text, readable_graph
 
 # get the graph and data
-graph, parents, data, vs = replay(db, db[-1])
+r = IncrementalReplay(db, db[-1])
 
 # make a graph with human readable names
-for k, v in graph.nodes.items():
+for k, v in r.graph.nodes.items():
     v.update(label=_clean_text(str(v['stream'])).strip())
-graph = readable_graph(graph)
+graph = readable_graph(r.graph)
 
 # create a plot of the graph so we can look at it and figure out what
 # the node names are
@@ -51,13 +51,14 @@ graph = readable_graph(graph)
 graph.nodes['data motor1 FromEventStream']['stream'].visualize()
 
 # print the results
-graph.nodes['result ToEventStream'].sink(pprint)
+graph.nodes['result ToEventStream']['stream'].sink(pprint)
 
-# change the multiplication factor from 5 to 10
-graph.nodes['map; add'].args = (10,)
+# run the analysis
+r.run()
 
-# rerun the analysis and print the results
-for v in vs:
-    dd = data[v['uid']]
-    parents[v["node"]].update(dd)
+# change the addition factor from 1 to 10
+graph.nodes['map; add']['stream'].args = (10,)
 
+# rerun the analysis and print the results, only the map and the nodes after
+# it are rerun
+r.run()
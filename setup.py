@@ -7,4 +7,7 @@ setup(
     # description='data processing module',
     zip_safe=False,
     url='http:/github.com/xpdAcq/shed',
+    entry_points={
+        'console_scripts': ['shed-replay = shed.replay:main'],
+    },
 )
@@ -1,8 +1,9 @@
+import threading
 import time
 from collections import MutableMapping
 
 import numpy as np
-from event_model import compose_run
+from event_model import compose_run, pack_event_page
 
 DTYPE_MAP = {
     np.ndarray: "array",
@@ -22,7 +23,14 @@ _GLOBAL_SCAN_ID = 0
 
 
 class CreateDocs(object):
-    def __init__(self, data_keys, data_key_md=None, **kwargs):
+    def __init__(
+        self,
+        data_keys,
+        data_key_md=None,
+        event_page_size=None,
+        event_page_interval=None,
+        **kwargs
+    ):
         if data_key_md is None:
             data_key_md = {}
         if isinstance(data_keys, str):
@@ -39,6 +47,16 @@ class CreateDocs(object):
         self.ev_fac = None
         self.evp_fac = None
 
+        self.event_page_size = event_page_size
+        self.event_page_interval = event_page_interval
+        self.paging = (
+            event_page_size is not None or event_page_interval is not None
+        )
+        self.event_buffer = []
+        self.event_buffer_time = None
+        # pages may be flushed by a timer on another thread
+        self._event_buffer_lock = threading.RLock()
+
     def start_doc(self, x):
         global _GLOBAL_SCAN_ID
         _GLOBAL_SCAN_ID += 1
@@ -102,6 +120,44 @@ class CreateDocs(object):
             validate=False,
         )
 
+    def buffer_event(self, event):
+        """Add an event to the page buffer
+
+        Returns
+        -------
+        event_page : dict or None
+            The page of buffered events if the page is full (or old enough),
+            otherwise None
+        """
+        now = time.time()
+        with self._event_buffer_lock:
+            if not self.event_buffer:
+                self.event_buffer_time = now
+            self.event_buffer.append(event)
+            if (
+                self.event_page_size is not None
+                and len(self.event_buffer) >= self.event_page_size
+            ) or (
+                self.event_page_interval is not None
+                and now - self.event_buffer_time >= self.event_page_interval
+            ):
+                return self.event_page()
+
+    def event_page(self):
+        """Pack the buffered events into an event page, clearing the buffer
+
+        Returns
+        -------
+        event_page : dict or None
+            The page of buffered events, None if there are no events
+        """
+        with self._event_buffer_lock:
+            if not self.event_buffer:
+                return None
+            events = self.event_buffer
+            self.event_buffer = []
+        return pack_event_page(*events)
+
     def stop(self, x):
         return self.stop_factory()
 
@@ -1,9 +1,26 @@
+import argparse
+import copy
+import heapq
 import importlib
-from collections import MutableMapping, Hashable
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import MutableMapping, Hashable, OrderedDict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    wait,
+)
+from functools import lru_cache
+from itertools import count
+from operator import itemgetter
 
 import networkx as nx
 from rapidz import Stream
 from shed import SimpleFromEventStream
+from shed.translation import _merkle_hashes
 
 
 # One problem we're facing is that the various pipelines handle document
@@ -47,7 +64,6 @@ def replay(db, hdr):
 
     """
     data = {}
-    parent_nodes = {}
     # TODO: try either raw or analysis db (or stash something to know who comes
     #  from where) Maybe take in a list of dbs?
     raw_hdrs = [db[u] for u in hdr["start"]["parent_node_map"].values()]
@@ -65,16 +81,7 @@ def replay(db, hdr):
 
     # get information from old analyzed header
     times = hdr["stop"]["times"]
-    graph = hdr["start"]["graph"]
-
-    loaded_graph = nx.node_link_graph(graph)
-    for n in nx.topological_sort(loaded_graph):
-        loaded_graph.nodes[n]["stream"] = rebuild_node(
-            loaded_graph.nodes[n]["stream"], loaded_graph
-        )
-
-    for node_uid in hdr["start"]["parent_node_map"]:
-        parent_nodes[node_uid] = loaded_graph.nodes[node_uid]["stream"]
+    loaded_graph, parent_nodes = _rebuild_graph(hdr)
 
     vs = [
         {'uid': dct['uid'], 'node': dct['node']}
@@ -86,39 +93,712 @@ def replay(db, hdr):
     return loaded_graph, parent_nodes, data, vs
 
 
-def rebuild_node(node_dict, graph):
+def replay_stream(db, hdr):
+    """Replay data analysis, streaming the documents from the databroker
+
+    Unlike ``replay`` the documents are pulled from the parent headers as
+    they are needed, so memory use doesn't grow with the size of the data.
+
+    Parameters
+    ----------
+    db : Broker instance
+        The databroker to pull data from
+    hdr : Header instance
+        The analyzed data header
+
+    Returns
+    -------
+    loaded_graph : DiGraph
+        The data processing pipeline as a graph
+    parent_nodes : dict
+        The source nodes for the graph
+    docs : generator
+        ``(node_uid, (name, doc))`` pairs, in the order the nodes originally
+        received the documents
+
+    Notes
+    -----
+    >>> graph, parents, docs = replay_stream(db, hdr)
+    >>> for node_uid, nd in docs:
+    ...     parents[node_uid].update(nd)
+
+    """
+    loaded_graph, parent_nodes = _rebuild_graph(hdr)
+    return loaded_graph, parent_nodes, _merged_documents(db, hdr)
+
+
+# graph hash -> _PipelineTemplate, the node ids of each header are mapped
+# onto the template's as they differ between instances of the same pipeline.
+# Only the parsing is cached, the nodes are built for every header. The least
+# recently used pipelines are dropped once there are more than
+# ``_pipeline_cache_size``
+_pipeline_cache = OrderedDict()
+_pipeline_cache_size = 32
+_pipeline_cache_lock = threading.Lock()
+
+
+def clear_pipeline_cache():
+    """Clear the cache of rebuilt pipelines"""
+    with _pipeline_cache_lock:
+        _pipeline_cache.clear()
+    _import.cache_clear()
+
+
+def _rebuild_graph(hdr):
+    graph = hdr["start"]["graph"]
+    key = hdr["start"].get("graph_hash")
+    template = None
+    ids = None
+    if key is not None:
+        with _pipeline_cache_lock:
+            template = _pipeline_cache.get(key)
+            if template is not None:
+                _pipeline_cache.move_to_end(key)
+        if template is not None:
+            ids = template.map_ids(graph)
+            # the nodes were serialized in another order, parse it again
+            if ids is None:
+                template = None
+    if template is None:
+        template = _PipelineTemplate(graph)
+        if key is not None:
+            with _pipeline_cache_lock:
+                _pipeline_cache[key] = template
+                while len(_pipeline_cache) > _pipeline_cache_size:
+                    _pipeline_cache.popitem(last=False)
+    loaded_graph = template.instantiate(ids)
+
+    parent_nodes = {
+        node_uid: loaded_graph.nodes[node_uid]["stream"]
+        for node_uid in hdr["start"]["parent_node_map"]
+    }
+    return loaded_graph, parent_nodes
+
+
+def _header_documents(docs, times):
+    # dispatch each document of a parent header to the nodes which logged
+    # it, in a single pass so only the current document is held
+    wanted = {}
+    for t in times:
+        wanted.setdefault(t["uid"], []).append((t["time"], t["node"]))
+    for nd in docs:
+        name, doc = nd
+        seen = wanted.pop(doc.get("uid", doc.get("datum_id")), None)
+        if seen is None:
+            continue
+        for t, node_uid in sorted(seen, key=itemgetter(0)):
+            yield t, node_uid, nd
+    for uid, seen in wanted.items():
+        raise KeyError(
+            f"Document {uid} seen by node {seen[0][1]} is not in its parent "
+            f"header"
+        )
+
+
+def _merged_documents(db, hdr):
+    node_headers = hdr["start"]["parent_node_map"]
+    header_times = {}
+    for t in hdr["stop"]["times"]:
+        # only the nodes which take data from a parent header are replayed
+        if t["node"] in node_headers:
+            header_times.setdefault(node_headers[t["node"]], []).append(t)
+
+    streams = [
+        _header_documents(db[start_uid].documents(), times)
+        for start_uid, times in header_times.items()
+    ]
+    # each header's documents are in order so a k-way merge puts them all in
+    # order
+    for t, node_uid, nd in heapq.merge(*streams, key=itemgetter(0)):
+        yield node_uid, nd
+
+
+class IncrementalReplay(object):
+    """Replay data analysis, only rerunning the parts of the pipeline which
+    changed
+
+    As the replay runs the outputs of every node are cached, keyed by the
+    node's merkle hash. When nodes are changed (eg. new ``args``) their hash
+    and the hashes of all their descendants change, so on the next ``run``
+    only those nodes are rerun, fed from the cached outputs of their
+    unchanged upstream nodes. Changing a ``FromEventStream`` node reruns
+    everything.
+
+    Parameters
+    ----------
+    db : Broker instance
+        The databroker to pull data from
+    hdr : Header instance
+        The analyzed data header
+
+    Attributes
+    ----------
+    graph : DiGraph
+        The data processing pipeline as a graph
+    parents : dict
+        The source nodes for the graph
+
+    Notes
+    -----
+    Only the nodes in ``graph`` are rerun, nodes added after the replay was
+    created (eg. sinks) only see new data if they are downstream of a changed
+    node. The outputs of every node are held in memory. The nodes which are
+    rerun are reset to the state they were built with first, so stateful
+    nodes (eg. ``accumulate``) give the same results as a fresh replay.
+
+    >>> r = IncrementalReplay(db, hdr)
+    >>> r.graph.nodes[tes_uid]["stream"].sink(print)
+    >>> r.run()
+    >>> r.graph.nodes[map_uid]["stream"].args = (10,)
+    >>> r.run()  # only reruns the map and the nodes after it
+    """
+
+    def __init__(self, db, hdr):
+        self.db = db
+        self.hdr = hdr
+        self.graph, self.parents = _rebuild_graph(hdr)
+        self.streams = {
+            attrs["stream"]: n for n, attrs in self.graph.nodes.items()
+        }
+        # merkle hash -> [(seq, output)]
+        self._outputs = {}
+        # ToEventStream -> [(seq, method name, input)] of the start and stop
+        # documents sent to it by its principle nodes
+        self._sideband = {}
+        # where the outputs of each node are logged in this run
+        self._logs = {}
+        self._recording_sideband = False
+        # the order of the input currently being replayed, everything it
+        # causes gets logged after it (and before the next input)
+        self._seq = ()
+        self._counter = count()
+        # the nodes are shared, not copied, when the state is copied
+        self._memo = {id(s): s for s in self.streams}
+        self._initial_state = {
+            s: _node_state(s, self._memo) for s in self.streams
+        }
+        for stream in self.streams:
+            stream._emit = self._log_emit(stream, stream._emit)
+            if hasattr(stream, "emit_start"):
+                for name in ["emit_start", "emit_stop"]:
+                    setattr(
+                        stream,
+                        name,
+                        self._log_sideband(
+                            stream, name, getattr(stream, name)
+                        ),
+                    )
+
+    def _next_seq(self):
+        return self._seq + (next(self._counter),)
+
+    def _log_emit(self, stream, emit):
+        def _emit(x):
+            log = self._logs.get(stream)
+            if log is not None:
+                log.append((self._next_seq(), x))
+            return emit(x)
+
+        return _emit
+
+    def _log_sideband(self, stream, name, method):
+        def log_method(x):
+            if self._recording_sideband:
+                self._sideband[stream].append((self._next_seq(), name, x))
+            return method(x)
+
+        return log_method
+
+    def _set_seq(self, seq):
+        self._seq = seq
+        self._counter = count()
+
+    def _reset(self, streams):
+        for s in streams:
+            s.__dict__.update(
+                copy.deepcopy(self._initial_state[s], dict(self._memo))
+            )
+
+    def hashes(self):
+        """The merkle hash of every node in the graph
+
+        Returns
+        -------
+        dict :
+            The hash for each node
+        """
+        hashes = {}
+        for stream in self.streams:
+            _merkle_hashes(stream, hashes)
+        return {s: hashes[s] for s in self.streams}
+
+    def run(self):
+        """Replay the data through the nodes which changed since the last run
+
+        Returns
+        -------
+        set :
+            The uids of the nodes which were rerun
+        """
+        hashes = self.hashes()
+        dirty = {s for s, h in hashes.items() if h not in self._outputs}
+        if any(isinstance(s, SimpleFromEventStream) for s in dirty):
+            self._run_all(hashes)
+            dirty = set(self.streams)
+        elif dirty:
+            self._run_dirty(hashes, dirty)
+        return {self.streams[s] for s in dirty}
+
+    def _run_all(self, hashes):
+        self._outputs = {h: [] for h in hashes.values()}
+        self._logs = {s: self._outputs[h] for s, h in hashes.items()}
+        self._sideband = {
+            s: [] for s in self.streams if hasattr(s, "emit_start")
+        }
+        self._reset(self.streams)
+        self._recording_sideband = True
+        try:
+            for i, (node_uid, nd) in enumerate(
+                _merged_documents(self.db, self.hdr)
+            ):
+                self._set_seq((i,))
+                self.parents[node_uid].update(nd)
+        finally:
+            self._recording_sideband = False
+            self._logs = {}
+
+    def _run_dirty(self, hashes, dirty):
+        inputs = []
+        for stream, h in hashes.items():
+            if stream in dirty:
+                continue
+            targets = [d for d in stream.downstreams if d in dirty]
+            if targets:
+                feed = _feed(targets, stream)
+                inputs.append([(seq, feed, x) for seq, x in self._outputs[h]])
+        # the sideband comes from the principle nodes which are unchanged
+        inputs.extend(
+            [(seq, getattr(s, name), x) for seq, name, x in self._sideband[s]]
+            for s in dirty
+            if s in self._sideband
+        )
+        self._reset(dirty)
+        for s in dirty:
+            self._outputs[hashes[s]] = []
+        self._logs = {s: self._outputs[hashes[s]] for s in dirty}
+        try:
+            for seq, f, x in heapq.merge(*inputs, key=itemgetter(0)):
+                self._set_seq(seq)
+                f(x)
+        finally:
+            self._logs = {}
+        # drop the outputs of nodes which have since changed
+        current = set(hashes.values())
+        self._outputs = {
+            h: v for h, v in self._outputs.items() if h in current
+        }
+
+
+# attributes which are the wiring or configuration of a node rather than its
+# state
+_NOT_STATE = {
+    "upstream",
+    "upstreams",
+    "downstreams",
+    "_emit",
+    "emit_start",
+    "emit_stop",
+    "args",
+    "kwargs",
+    "func",
+    "loop",
+    "_init_args",
+    "_init_kwargs",
+    "uid",
+    "graph",
+    "translation_nodes",
+    "principle_nodes",
+    "subs",
+    # shared by the whole pipeline
+    "_translation_index",
+}
+
+
+def _node_state(stream, memo):
+    # a copy of the state of ``stream`` which can be restored to reset it
+    state = {}
+    for k, v in stream.__dict__.items():
+        if k in _NOT_STATE:
+            continue
+        try:
+            state[k] = copy.deepcopy(v, dict(memo))
+        except (TypeError, copy.Error):
+            # things which can't be copied (eg. locks) are left alone
+            continue
+    return state
+
+
+def _feed(targets, who):
+    def feed(x):
+        for t in targets:
+            t.update(x, who=who)
+
+    return feed
+
+
+@lru_cache(maxsize=None)
+def _named_db(name):
+    from databroker import Broker
+
+    return Broker.named(name)
+
+
+def replay_header(db, uid, insert=True):
+    """Replay the analysis of a single analyzed header
+
+    Parameters
+    ----------
+    db : Broker instance or str
+        The databroker (or the name of its configuration) to pull data from
+    uid : str
+        The uid of the analyzed header
+    insert : bool, optional
+        If True insert the replayed analysis into ``db``, defaults to True
+
+    Returns
+    -------
+    dict :
+        The ``uid``, the number of ``documents`` replayed, the number of
+        ``outputs`` produced, the ``elapsed`` time and the ``error`` (a
+        traceback) if the replay failed
+    """
+    t0 = time.time()
+    result = {"uid": uid, "documents": 0, "outputs": 0, "error": None}
+    try:
+        if isinstance(db, str):
+            db = _named_db(db)
+        hdr = db[uid]
+        graph, parents, docs = replay_stream(db, hdr)
+        outbound = graph.nodes[hdr["start"]["outbound_node"]]["stream"]
+        dbf = outbound.DBFriendly()
+
+        def count_output(x):
+            result["outputs"] += 1
+
+        dbf.sink(count_output)
+        if insert:
+            dbf.starsink(db.insert)
+        for node_uid, nd in docs:
+            parents[node_uid].update(nd)
+            result["documents"] += 1
+    except Exception:
+        result["error"] = traceback.format_exc()
+    result["elapsed"] = time.time() - t0
+    return result
+
+
+def replay_many(
+    db, uids, max_workers=None, insert=True, progress=None, executor=None
+):
+    """Replay the analysis of many analyzed headers in parallel
+
+    Parameters
+    ----------
+    db : Broker instance or str
+        The databroker (or the name of its configuration) to pull data from.
+        Worker processes can't share a Broker instance so pass the name when
+        using the default process pool.
+    uids : iterable of str
+        The uids of the analyzed headers
+    max_workers : int, optional
+        The number of headers to replay at once, defaults to the number of
+        CPUs
+    insert : bool, optional
+        If True insert the replayed analysis into ``db``, defaults to True
+    progress : callable, optional
+        Called with the result of each header (see ``replay_header``), the
+        number of headers done and the total number of headers as they
+        finish
+    executor : Executor, optional
+        The executor to run the replays on, defaults to a process pool with
+        ``max_workers`` processes
+
+    Returns
+    -------
+    dict :
+        The ``results`` of each header (in the order they finished), the
+        tracebacks of the ``failed`` headers (keyed by uid), the total number
+        of ``headers`` and ``documents``, the ``elapsed`` time and the
+        ``headers_per_second`` and ``documents_per_second``
+    """
+    uids = list(uids)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers)
+
+    t0 = time.time()
+    results = []
+
+    def collect(futures):
+        for future in futures:
+            try:
+                result = future.result()
+            except Exception:
+                # the worker couldn't run (eg. the arguments don't pickle)
+                result = {
+                    "uid": pending[future],
+                    "documents": 0,
+                    "outputs": 0,
+                    "error": traceback.format_exc(),
+                    "elapsed": 0.,
+                }
+            del pending[future]
+            results.append(result)
+            if progress is not None:
+                progress(result, len(results), len(uids))
+
+    pending = {}
+    try:
+        for uid in uids:
+            if len(pending) >= max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending[executor.submit(replay_header, db, uid, insert)] = uid
+        collect(wait(pending).done)
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    elapsed = time.time() - t0
+    documents = sum(r["documents"] for r in results)
+    return {
+        "results": results,
+        "failed": {r["uid"]: r["error"] for r in results if r["error"]},
+        "headers": len(results),
+        "documents": documents,
+        "elapsed": elapsed,
+        "headers_per_second": len(results) / elapsed if elapsed else 0.,
+        "documents_per_second": documents / elapsed if elapsed else 0.,
+    }
+
+
+def _print_progress(result, done, total):
+    status = "failed" if result["error"] else "ok"
+    print(
+        f"[{done}/{total}] {result['uid']} {status} "
+        f"({result['documents']} documents in {result['elapsed']:.2f}s)"
+    )
+
+
+def main(argv=None):
+    """Replay analyzed headers from the command line"""
+    parser = argparse.ArgumentParser(
+        prog="shed-replay",
+        description="Replay the analysis of analyzed headers",
+    )
+    parser.add_argument("db", help="name of the databroker configuration")
+    parser.add_argument(
+        "uids",
+        nargs="+",
+        help="uids of the analyzed headers, - reads them from stdin",
+    )
+    parser.add_argument(
+        "-j",
+        "--max-workers",
+        type=int,
+        default=None,
+        help="number of headers to replay at once (defaults to the CPUs)",
+    )
+    parser.add_argument(
+        "--no-insert",
+        action="store_false",
+        dest="insert",
+        help="don't insert the replayed analysis into the databroker",
+    )
+    args = parser.parse_args(argv)
+    uids = []
+    for uid in args.uids:
+        if uid == "-":
+            uids.extend(line.strip() for line in sys.stdin if line.strip())
+        else:
+            uids.append(uid)
+
+    summary = replay_many(
+        args.db,
+        uids,
+        max_workers=args.max_workers,
+        insert=args.insert,
+        progress=_print_progress,
+    )
+    print(
+        f"Replayed {summary['headers']} headers ({summary['documents']} "
+        f"documents) in {summary['elapsed']:.2f}s, "
+        f"{summary['headers_per_second']:.2f} headers/s, "
+        f"{summary['documents_per_second']:.1f} documents/s"
+    )
+    for uid, error in summary["failed"].items():
+        print(f"{uid} failed:\n{error}", file=sys.stderr)
+    if summary["failed"]:
+        print(f"{len(summary['failed'])} headers failed", file=sys.stderr)
+        return 1
+    return 0
+
+
+@lru_cache(maxsize=None)
+def _import(mod, name):
+    return getattr(importlib.import_module(mod), name)
+
+
+# How each arg/kwarg of a rebuilt node is resolved
+_VALUE = "value"
+_COPY = "copy"
+_NODE = "node"
+_PLACEHOLDER = "placeholder"
+
+
+def _is_func(a):
+    return isinstance(a, MutableMapping) and a.get("name") and a.get("mod")
+
+
+def _value(a):
+    # containers are copied so the nodes built from a template don't share
+    # state
+    if isinstance(a, (list, MutableMapping, set)):
+        return _COPY, a
+    return _VALUE, a
+
+
+def _node_recipe(node_dict, graph):
     d = dict(node_dict)
-    node = getattr(importlib.import_module(d["mod"]), d["name"])
-    d.pop("name")
-    d.pop("mod")
+    node = _import(d["mod"], d["name"])
 
     aa = []
     for a in d["args"]:
-        if isinstance(a, MutableMapping) and a.get("name") and a.get("mod"):
-            aa.append(getattr(importlib.import_module(a["mod"]), a["name"]))
+        if _is_func(a):
+            aa.append((_VALUE, _import(a["mod"], a["name"])))
         elif isinstance(a, (tuple, list)):
-            aa.append(a)
+            aa.append(_value(a))
         elif a in graph.nodes:
-            aa.append(graph.nodes[a]["stream"])
+            aa.append((_NODE, a))
         else:
-            aa.append(a)
-    d["args"] = aa
+            aa.append(_value(a))
 
     kk = {}
     for k, a in d["kwargs"].items():
         # We can't check if non hashables are in the graph (also I don't think
         # we can put non hashables as nodes in the graph)
         if isinstance(a, Hashable) and a in graph.nodes:
-            kk[k] = graph.nodes[a]["stream"]
-        elif isinstance(a, MutableMapping) and a.get("name") and a.get("mod"):
-            kk[k] = getattr(importlib.import_module(a["mod"]), a["name"])
+            kk[k] = (_NODE, a)
+        elif _is_func(a):
+            kk[k] = (_VALUE, _import(a["mod"], a["name"]))
         # If there is an upstream node for our FromEventStream node then
         # it is out of scope, make a Placeholder node to keep the instantiation
         # happy
         elif issubclass(node, SimpleFromEventStream) and k == "upstream":
-            kk[k] = Stream(stream_name="Placeholder")
+            kk[k] = (_PLACEHOLDER, None)
         else:
-            kk[k] = a
-    d["kwargs"] = kk
-    n = node(*d["args"], **d["kwargs"])
-    return n
+            kk[k] = _value(a)
+    return node, aa, kk
+
+
+def _resolve(arg, graph):
+    kind, a = arg
+    if kind == _NODE:
+        return graph.nodes[a]["stream"]
+    elif kind == _COPY:
+        return copy.deepcopy(a)
+    elif kind == _PLACEHOLDER:
+        return Stream(stream_name="Placeholder")
+    return a
+
+
+def _build_node(recipe, graph):
+    node, args, kwargs = recipe
+    return node(
+        *[_resolve(a, graph) for a in args],
+        **{k: _resolve(a, graph) for k, a in kwargs.items()},
+    )
+
+
+def _graph_shape(graph):
+    # the classes of the nodes and the links between them, by position
+    positions = {n["id"]: i for i, n in enumerate(graph["nodes"])}
+    nodes = tuple(
+        (n.get("stream", {}).get("mod"), n.get("stream", {}).get("name"))
+        for n in graph["nodes"]
+    )
+    links = frozenset(
+        (positions[link["source"]], positions[link["target"]])
+        for link in graph.get("links", graph.get("edges", ()))
+    )
+    return nodes, links
+
+
+class _PipelineTemplate(object):
+    """A parsed pipeline graph which can be built many times
+
+    Only the parsing (importing the nodes, sorting them and working out their
+    args) is done once, building the pipeline still builds every node.
+    """
+
+    def __init__(self, graph):
+        self.ids = [n["id"] for n in graph["nodes"]]
+        self.shape = _graph_shape(graph)
+        self.graph = nx.node_link_graph(graph)
+        self.recipes = [
+            (n, _node_recipe(self.graph.nodes[n]["stream"], self.graph))
+            for n in nx.topological_sort(self.graph)
+        ]
+
+    def map_ids(self, graph):
+        """Map the node ids of another serialization of the pipeline onto the
+        template's, the nodes are matched by their position
+
+        Parameters
+        ----------
+        graph : dict
+            The serialized graph (with the same graph hash)
+
+        Returns
+        -------
+        dict or None :
+            The ids of ``graph`` keyed by the template's ids, None if the
+            nodes don't line up
+        """
+        ids = [n["id"] for n in graph["nodes"]]
+        if ids == self.ids:
+            return {}
+        if _graph_shape(graph) != self.shape:
+            return None
+        return dict(zip(self.ids, ids))
+
+    def instantiate(self, ids=None):
+        """Build a new pipeline
+
+        Parameters
+        ----------
+        ids : dict, optional
+            New ids for the nodes, keyed by the template's ids (see
+            ``map_ids``)
+
+        Returns
+        -------
+        DiGraph :
+            The graph of the pipeline, with new nodes
+        """
+        graph = self.graph.copy()
+        for n, recipe in self.recipes:
+            graph.nodes[n]["stream"] = _build_node(recipe, graph)
+        if ids:
+            graph = nx.relabel_nodes(graph, ids)
+        return graph
+
+
+def rebuild_node(node_dict, graph):
+    return _build_node(_node_recipe(node_dict, graph), graph)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
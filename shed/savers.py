@@ -15,6 +15,8 @@
 ##############################################################################
 
 import numpy as np
+import threading
+import time
 import uuid
 import os
 
@@ -23,15 +25,55 @@ class NpyWriter:
     """
     Each call to the ``write`` method saves a file and creates a new filestore
     resource and datum record.
+
+    Parameters
+    ----------
+    fs : Registry
+        The registry to insert the resources and datums into
+    root : str
+        The directory to write to
+    buffered : bool, optional
+        If True the resources and datums are inserted in bulk rather than as
+        they are written. They are inserted once ``max_buffer`` are waiting,
+        ``flush_interval`` seconds after the last insert and on ``close``.
+        Each write has its own resource so this makes as many inserts as
+        unbuffered writing, it only moves them off of ``write`` (into
+        bursts, or onto a thread with ``background``). Defaults to False
+    max_buffer : int, optional
+        The number of writes to buffer, defaults to 1000
+    flush_interval : float, optional
+        The maximum seconds between inserts, defaults to no limit
+    background : bool, optional
+        If True insert from a background thread every ``flush_interval``
+        (defaults to 1) seconds, rather than when ``write`` is called.
+        Implies ``buffered``. Defaults to False
     """
 
     SPEC = 'npy'
 
-    def __init__(self, fs, root):
+    def __init__(self, fs, root, buffered=False, max_buffer=1000,
+                 flush_interval=None, background=False):
         self._root = root
         self._closed = False
         self._fs = fs
         # Open and stash a file handle (e.g., h5py.File) if applicable.
+        self._buffered = buffered or background
+        self._max_buffer = max_buffer
+        self._flush_interval = flush_interval
+        # [file path, resource uid, datum id, inserted resource] waiting to
+        # be inserted, the resource is None until it has been inserted
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._error = None
+        self._flusher = None
+        if background:
+            if flush_interval is None:
+                self._flush_interval = 1.
+            self._wake = threading.Event()
+            self._flusher = threading.Thread(target=self._flush_loop,
+                                             daemon=True)
+            self._flusher.start()
 
     def write(self, data):
         """
@@ -39,17 +81,80 @@ class NpyWriter:
         """
         if self._closed:
             raise RuntimeError('This writer has been closed.')
+        self._raise_error()
         fp = '{}.npy'.format(str(uuid.uuid4()))
         np.save(os.path.join(self._root, fp), data)
+        datum_id = str(uuid.uuid4())
+        if self._buffered:
+            with self._lock:
+                self._buffer.append([fp, str(uuid.uuid4()), datum_id, None])
+                n = len(self._buffer)
+            if self._flusher is not None:
+                if n >= self._max_buffer:
+                    self._wake.set()
+            elif (n >= self._max_buffer
+                  or (self._flush_interval is not None
+                      and time.time() - self._last_flush
+                      >= self._flush_interval)):
+                self.flush()
+            return datum_id
         resource = self._fs.insert_resource(self.SPEC, fp, resource_kwargs={},
                                             root=self._root)
-        datum_id = str(uuid.uuid4())
         self._fs.insert_datum(resource=resource, datum_id=datum_id,
                               datum_kwargs={})
         return datum_id
 
+    def flush(self):
+        """Insert the buffered resources and datums"""
+        with self._lock:
+            buffer, self._buffer = self._buffer, []
+            self._last_flush = time.time()
+        for i, entry in enumerate(buffer):
+            fp, resource_uid, datum_id, resource = entry
+            try:
+                if resource is None:
+                    resource = self._fs.insert_resource(
+                        self.SPEC, fp, resource_kwargs={}, root=self._root,
+                        uid=resource_uid)
+                    # don't insert the resource again on a retry
+                    entry[3] = resource
+                self._fs.insert_datum(resource=resource, datum_id=datum_id,
+                                      datum_kwargs={})
+            except Exception:
+                # put the failed write and the rest back for the next flush
+                with self._lock:
+                    self._buffer[:0] = buffer[i:]
+                raise
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wake.wait(self._flush_interval)
+            self._wake.clear()
+            self._flush_in_background()
+        self._flush_in_background()
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        except Exception as e:
+            # raise it on the writer's thread
+            self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise e
+
     def close(self):
+        if self._closed:
+            return
         self._closed = True
+        if self._flusher is not None:
+            self._wake.set()
+            self._flusher.join()
+        elif self._buffered:
+            self.flush()
+        self._raise_error()
 
     def __enter__(self):
         return self
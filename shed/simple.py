@@ -1,11 +1,14 @@
 """Nodes for translating between base data and event model"""
+import sys
+import threading
 import time
 import uuid
 from collections import deque, Mapping
+from types import MappingProxyType
 
 import networkx as nx
 import numpy as np
-from event_model import compose_descriptor, compose_run
+from event_model import compose_descriptor, compose_run, unpack_event_page
 from rapidz.core import Stream, zip as szip, move_to_first
 from xonsh.lib.collections import ChainDB, _convert_to_dict
 
@@ -16,10 +19,120 @@ ALL = "--ALL THE DOCS--"
 DTYPE_MAP = {np.ndarray: "array", int: "number", float: "number"}
 
 
+_MISSING = object()
+
+
 def _hash_or_uid(node):
     return getattr(node, "uid", hash(node))
 
 
+def sizeof(obj):
+    """Estimate the memory used by an object and the containers in it
+
+    Dicts, lists, tuples, sets and deques are walked into, numpy arrays
+    include their data (if they own it). Stream nodes are not counted and
+    other objects are counted with ``sys.getsizeof``.
+
+    Parameters
+    ----------
+    obj : object
+        The object to size
+
+    Returns
+    -------
+    int :
+        The estimated size in bytes
+    """
+    size = 0
+    seen = set()
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, Stream):
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, Mapping):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            stack.extend(o)
+    return size
+
+
+def _get_key(key):
+    def get(inner):
+        if key in inner:
+            return inner[key]
+        return _MISSING
+
+    return get
+
+
+def _get_keys(keys):
+    def get(inner):
+        return tuple(inner[k] for k in keys)
+
+    return get
+
+
+def compile_data_address(data_address):
+    """Compile a data address into a single getter function
+
+    Parameters
+    ----------
+    data_address : tuple
+        A tuple of successive keys walking through the document, tuples of
+        keys inside the address pull out multiple things at once
+
+    Returns
+    -------
+    get : callable
+        Function which takes a document and returns the addressed data or
+        ``_MISSING`` if the address is not in the document
+
+    Notes
+    -----
+    The address is only walked once, when the getter is built, so the
+    getter does no type checking on the hot path. The common
+    ``('data', key)`` address gets a dedicated getter.
+    """
+    # If we have an empty address get everything
+    if data_address == ():
+        return lambda inner: inner
+    if (
+        len(data_address) == 2
+        and data_address[0] == "data"
+        and not isinstance(data_address[1], tuple)
+    ):
+        key = data_address[1]
+
+        def get_data_key(inner):
+            data = inner.get("data", _MISSING)
+            if data is _MISSING or key not in data:
+                return _MISSING
+            return data[key]
+
+        return get_data_key
+
+    # If it's a tuple we want multiple things at once
+    getters = [
+        _get_keys(da) if isinstance(da, tuple) else _get_key(da)
+        for da in data_address
+    ]
+    if len(getters) == 1:
+        return getters[0]
+
+    def get_chain(inner):
+        for get in getters:
+            inner = get(inner)
+            if inner is _MISSING:
+                return _MISSING
+        return inner
+
+    return get_chain
+
+
 def build_upstream_node_set(node, s=None):
     """Build a set of all the nodes in a rapidz graph
 
@@ -47,7 +160,7 @@ def build_upstream_node_set(node, s=None):
     return s
 
 
-def walk_to_translation(node, graph, prior_node=None):
+def walk_to_translation(node, graph, prior_node=None, index=None):
     """Creates a graph that is a subset of the graph from the stream.
 
     The walk starts at a translation ``ToEventStream`` node and ends at any
@@ -64,34 +177,302 @@ def walk_to_translation(node, graph, prior_node=None):
     node : Stream instance
     graph : DiGraph instance
     prior_node : Stream instance
+    index : TranslationGraphIndex instance, optional
+        If provided the walks above nodes with multiple downstreams are
+        memoized in (and reused from) the index
     """
-    if node is None:
-        return
-    t = _hash_or_uid(node)
-    graph.add_node(t, stream=node)
-    if prior_node:
-        tt = _hash_or_uid(prior_node)
-        if graph.has_edge(t, tt):
-            return
-        else:
+    # The walk is depth first, the stack is popped in the same order the
+    # recursion would visit the nodes so deep pipelines don't hit the
+    # recursion limit
+    stack = [(node, prior_node)]
+    while stack:
+        node, prior_node = stack.pop()
+        if node is None:
+            continue
+        t = _hash_or_uid(node)
+        graph.add_node(t, stream=node)
+        if prior_node:
+            tt = _hash_or_uid(prior_node)
+            if graph.has_edge(t, tt):
+                continue
             graph.add_edge(t, tt)
             if isinstance(node, SimpleFromEventStream):
-                return
-            else:
-                for downstream in node.downstreams:
-                    ttt = _hash_or_uid(downstream)
-                    if (
-                            isinstance(downstream, SimpleToEventStream)
-                            and ttt not in graph
-                    ):
-                        graph.add_node(ttt, stream=downstream)
-                        graph.add_edge(t, ttt)
-                        return
-
-    for node2 in node.upstreams:
+                continue
+            translation_downstream = False
+            for downstream in node.downstreams:
+                ttt = _hash_or_uid(downstream)
+                if (
+                    isinstance(downstream, SimpleToEventStream)
+                    and ttt not in graph
+                ):
+                    graph.add_node(ttt, stream=downstream)
+                    graph.add_edge(t, ttt)
+                    translation_downstream = True
+                    break
+            if translation_downstream:
+                continue
+            if index is not None and index.add_upstream_walk(node, graph):
+                continue
+
         # Stop at translation node
-        if node2 is not None:
-            walk_to_translation(node2, graph, node)
+        stack.extend(
+            (node2, node)
+            for node2 in reversed(node.upstreams)
+            if node2 is not None
+        )
+
+
+class _TranslationWalk(object):
+    """The part of a ``TranslationGraphIndex`` graph walked from one node
+
+    This supports the parts of the ``DiGraph`` API which
+    ``walk_to_translation`` uses, nodes and edges are added to the shared
+    graph and the keys are kept so a view can be made of them."""
+
+    def __init__(self, index):
+        self.index = index
+        self.nodes = set()
+        self.edges = set()
+
+    def __contains__(self, n):
+        return n in self.nodes
+
+    def has_edge(self, u, v):
+        return (u, v) in self.edges
+
+    def add_node(self, n, stream):
+        self.nodes.add(n)
+        self.index = self.index.add_node(n, stream)
+
+    def add_edge(self, u, v):
+        self.edges.add((u, v))
+        self.index.graph.add_edge(u, v)
+
+    def view(self):
+        return nx.subgraph_view(
+            self.index.resolve().graph,
+            filter_node=frozenset(self.nodes).__contains__,
+            filter_edge=_ShowEdges(self.edges),
+        )
+
+
+class _ShowEdges(object):
+    """Edge filter for ``nx.subgraph_view`` which (unlike
+    ``nx.filters.show_diedges``) doesn't copy the edges"""
+
+    def __init__(self, edges):
+        self.edges = frozenset(edges)
+
+    def __call__(self, u, v):
+        return (u, v) in self.edges
+
+
+class TranslationGraphIndex(object):
+    """Graph of the translation walks through a pipeline
+
+    The ``ToEventStream`` nodes of a pipeline share an index, each of them
+    holds a read only view of the part of the shared graph it walked. The
+    walks above nodes with multiple downstreams (which are what the
+    ``ToEventStream`` nodes share) are memoized, as long as no
+    ``ToEventStream`` hangs off of them, so they are only walked once.
+
+    Nodes keep a reference to their index as ``_translation_index``, if a
+    walk finds nodes from another index the smaller is merged into the
+    larger one.
+    """
+
+    def __init__(self):
+        self.graph = nx.DiGraph()
+        # node key -> (node keys, edges, (node, upstreams) pairs) for the
+        # walk above the node or None if it can't be reused
+        self.walks = {}
+        # node key -> keys of the memoized walks which contain it
+        self.members = {}
+        # the index this one was merged into
+        self.merged_into = None
+
+    def resolve(self):
+        """The index this index was (eventually) merged into"""
+        index = self
+        while index.merged_into is not None:
+            index = index.merged_into
+        return index
+
+    @staticmethod
+    def of(stream):
+        """The index of a node, None if it hasn't been walked"""
+        index = getattr(stream, "_translation_index", None)
+        if index is not None and index.merged_into is not None:
+            index = index.resolve()
+            stream._translation_index = index
+        return index
+
+    @classmethod
+    def get(cls, node):
+        """Get the index of the pipeline ``node`` is in, creating one if
+        needed"""
+        seen = set()
+        stack = list(node.upstreams)
+        while stack:
+            n = stack.pop()
+            if n is None or id(n) in seen:
+                continue
+            seen.add(id(n))
+            index = cls.of(n)
+            if index is not None:
+                return index
+            if not isinstance(n, SimpleFromEventStream):
+                stack.extend(n.upstreams)
+        return cls()
+
+    def add_node(self, n, stream):
+        """Add a node to the graph
+
+        Returns
+        -------
+        index : TranslationGraphIndex
+            The index the node was added to, which is different from this
+            one if the node was in a larger index
+        """
+        index = self.of(stream)
+        if index is None:
+            stream._translation_index = self
+        elif index is not self:
+            return self.merge(index).add_node(n, stream)
+        if n not in self.graph:
+            self.graph.add_node(n, stream=stream)
+        return self
+
+    def merge(self, other):
+        """Merge two indices, returning the merged index"""
+        if len(other.graph) > len(self.graph):
+            return other.merge(self)
+        self.graph.add_nodes_from(other.graph.nodes(data=True))
+        self.graph.add_edges_from(other.graph.edges)
+        self.walks.update(other.walks)
+        for k, v in other.members.items():
+            self.members.setdefault(k, set()).update(v)
+        other.merged_into = self
+        return self
+
+    def invalidate(self, node):
+        """Drop the memoized walks which contain ``node``"""
+        for k in self.members.pop(_hash_or_uid(node), ()):
+            self.walks.pop(k, None)
+
+    def walk(self, node):
+        """Walk up from ``node``, returning a view of the walked graph
+
+        Parameters
+        ----------
+        node : Stream instance
+            The translation node to walk up from
+
+        Returns
+        -------
+        graph : DiGraph
+            The read only view of the walked part of the shared graph
+        """
+        # a new translation node changes the walks through its upstreams
+        for u in node.upstreams:
+            index = self.of(u)
+            if index is not None:
+                index.invalidate(u)
+        w = _TranslationWalk(self)
+        walk_to_translation(node, w, index=self)
+        return w.view()
+
+    def add_upstream_walk(self, node, walk):
+        """Add the memoized walk above ``node`` to ``walk``
+
+        Returns
+        -------
+        bool :
+            True if the memoized walk was used, False if ``node``'s
+            upstreams still need to be walked
+        """
+        if len(node.downstreams) < 2:
+            return False
+        index = self.resolve()
+        t = _hash_or_uid(node)
+        memo = index.walks.get(t, _MISSING)
+        if memo is _MISSING or (
+            memo is not None
+            and any(n.upstreams != ups for n, ups in memo[2])
+        ):
+            memo = index._upstream_walk(node)
+        if memo is None:
+            return False
+        walk.nodes |= memo[0]
+        walk.edges |= memo[1]
+        return True
+
+    def _upstream_walk(self, node):
+        # Walk above ``node`` without reference to any other walk. This is
+        # only the same as ``walk_to_translation`` if no translation nodes
+        # are found on the way, if they are we give up.
+        index = self
+        t = _hash_or_uid(node)
+        nodes = set()
+        edges = set()
+        upstreams = [(node, list(node.upstreams))]
+        stack = [(u, node) for u in reversed(node.upstreams) if u is not None]
+        while stack:
+            n, prior_node = stack.pop()
+            tn = _hash_or_uid(n)
+            index = index.add_node(tn, n)
+            edge = (tn, _hash_or_uid(prior_node))
+            edges.add(edge)
+            index.graph.add_edge(*edge)
+            if tn in nodes:
+                continue
+            nodes.add(tn)
+            if isinstance(n, SimpleFromEventStream):
+                continue
+            if any(
+                isinstance(downstream, SimpleToEventStream)
+                for downstream in n.downstreams
+            ):
+                index.walks[t] = None
+                return None
+            memo = index.walks.get(tn)
+            if memo is not None and all(
+                nn.upstreams == ups for nn, ups in memo[2]
+            ):
+                nodes |= memo[0]
+                edges |= memo[1]
+                upstreams.extend(memo[2])
+                continue
+            upstreams.append((n, list(n.upstreams)))
+            stack.extend(
+                (u, n) for u in reversed(n.upstreams) if u is not None
+            )
+        memo = (frozenset(nodes), frozenset(edges), tuple(upstreams))
+        index.walks[t] = memo
+        for n in nodes | {t}:
+            index.members.setdefault(n, set()).add(t)
+        return memo
+
+
+def build_translation_graph(node):
+    """Build the graph between a translation node and the translation nodes
+    upstream of it
+
+    The graph is a view of a ``TranslationGraphIndex`` shared by the
+    pipeline, see ``walk_to_translation`` for the walk itself.
+
+    Parameters
+    ----------
+    node : Stream instance
+        The translation node
+
+    Returns
+    -------
+    graph : DiGraph
+        Read only graph of the nodes between ``node`` and the upstream
+        translation nodes
+    """
+    return TranslationGraphIndex.get(node).walk(node)
 
 
 @Stream.register_api()
@@ -107,6 +488,12 @@ class simple_to_event_stream(Stream, CreateDocs):
         the keys from the dict. Defauls to None
     stream_name : str, optional
         Name for this stream node
+    event_page_size : int, optional
+        If provided events are emitted as ``event_page`` documents holding
+        this many events. Defaults to None
+    event_page_interval : float, optional
+        If provided events are emitted as ``event_page`` documents once the
+        oldest event in the page is this many seconds old. Defaults to None
 
     Notes
     -----
@@ -117,6 +504,9 @@ class simple_to_event_stream(Stream, CreateDocs):
     Note that start -> start is not allowed, this node always issues a stop
     document so the data input times can be stored.
 
+    When emitting event pages, any partial page is emitted before the
+    stop document.
+
     Examples
     --------
     >>> import uuid
@@ -150,13 +540,24 @@ class simple_to_event_stream(Stream, CreateDocs):
             data_keys=None,
             stream_name=None,
             data_key_md=None,
+            event_page_size=None,
+            event_page_interval=None,
             **kwargs,
     ):
         if stream_name is None:
             stream_name = str(data_keys)
 
         Stream.__init__(self, upstream, stream_name=stream_name)
-        CreateDocs.__init__(self, data_keys, data_key_md=data_key_md, **kwargs)
+        CreateDocs.__init__(
+            self,
+            data_keys,
+            data_key_md=data_key_md,
+            event_page_size=event_page_size,
+            event_page_interval=event_page_interval,
+            **kwargs,
+        )
+        # number of pages emitted, so timers know if their page is gone
+        self._page_count = 0
 
         move_to_first(self)
 
@@ -170,8 +571,7 @@ class simple_to_event_stream(Stream, CreateDocs):
 
         # walk upstream to get all upstream nodes to the translation node
         # get start_uids from the translation node
-        self.graph = nx.DiGraph()
-        walk_to_translation(self, graph=self.graph)
+        self.graph = build_translation_graph(self)
 
         self.translation_nodes = {
             k: n["stream"]
@@ -256,12 +656,39 @@ class simple_to_event_stream(Stream, CreateDocs):
             self.incoming_stop_uid = doc["uid"]
             # Prime for next run
             self.incoming_start_uid = None
+        self.emit_event_page()
         stop = self.create_doc("stop", x)
         ret = self.emit(stop)
         [s.emit_stop(x) for s in self.subs]
         self.state = "stopped"
         return ret
 
+    def emit_event_page(self):
+        """Emit the buffered events as an event page, if there are any"""
+        # emit under the lock so the pages go out in order
+        with self._event_buffer_lock:
+            page = self.event_page()
+            if page is None:
+                return
+            self._page_count += 1
+            return self.emit(("event_page", page))
+
+    def _emit_event_page(self, page_count):
+        with self._event_buffer_lock:
+            # Only emit if the page the timer was made for is still around
+            if page_count == self._page_count:
+                self.emit_event_page()
+
+    def memory_usage(self):
+        """The estimated memory (in bytes) used by the state of this node
+
+        Returns
+        -------
+        dict :
+            The size of each piece of state
+        """
+        return {"event_buffer": sizeof(self.event_buffer)}
+
     def update(self, x, who=None):
         rl = []
         # If we have a start document ready to go, release it.
@@ -273,8 +700,28 @@ class simple_to_event_stream(Stream, CreateDocs):
         if self.state == "started":
             rl.append(self.emit(self.create_doc("descriptor", x)))
             self.state = "described"
-        rl.append(self.emit(self.create_doc("event", x)))
+        if not self.paging:
+            rl.append(self.emit(self.create_doc("event", x)))
+            return rl
 
+        name, event = self.create_doc("event", x)
+        with self._event_buffer_lock:
+            if (
+                    not self.event_buffer
+                    and self.event_page_interval is not None
+                    and self.loop is not None
+            ):
+                # add_callback is thread safe, call_later is not
+                self.loop.add_callback(
+                    self.loop.call_later,
+                    self.event_page_interval,
+                    self._emit_event_page,
+                    self._page_count,
+                )
+            page = self.buffer_event(event)
+            if page is not None:
+                self._page_count += 1
+                rl.append(self.emit(("event_page", page)))
         return rl
 
 
@@ -389,8 +836,7 @@ class simple_to_event_stream_new_api(Stream):
 
         # walk upstream to get all upstream nodes to the translation node
         # get start_uids from the translation node
-        self.graph = nx.DiGraph()
-        walk_to_translation(self, graph=self.graph)
+        self.graph = build_translation_graph(self)
 
         self.translation_nodes = {
             k: n["stream"]
@@ -486,6 +932,16 @@ class simple_to_event_stream_new_api(Stream):
         self.state = "stopped"
         return ret
 
+    def memory_usage(self):
+        """The estimated memory (in bytes) used by the state of this node
+
+        Returns
+        -------
+        dict :
+            The size of each piece of state
+        """
+        return {"descriptors": sizeof(self.descriptors)}
+
     def update(self, x, who=None):
         rl = []
         # If we have a start document ready to go, release it.
@@ -590,12 +1046,35 @@ class simple_from_event_stream(Stream):
         downstream ToEventStream nodes will issue a stop document.
         Defaults to False. Note that one principle node is required for
         proper pipeline operation.
+    zero_copy : bool, optional
+        If True the incoming documents are not copied, the data address is
+        looked up on a read-only view of the document and only mappings which
+        are emitted are (shallowly) copied. Defaults to False.
+    columnar : bool, optional
+        If True ``event_page`` documents are emitted as a whole, with each
+        addressed column converted to an array. Otherwise each row of the page
+        is emitted as if it were an ``event``. Defaults to False.
+    batch : int, optional
+        If provided the data from this many consecutive events is stacked
+        into one array and emitted along with the list of the event uids,
+        as ``(array, uids)``. Defaults to None.
+    max_latency : float, optional
+        If provided the batch is emitted once its oldest data is this many
+        seconds old, even if the batch is not full. Defaults to None.
 
     Notes
     -----
     The result emitted from this stream no longer follows the document
     model.
 
+    Nodes extracting from ``event`` documents also extract from
+    ``event_page`` documents.
+
+    When batching, partial batches are emitted when the stop (or the next
+    start) document comes in, or by calling ``flush``. The ``max_latency``
+    is checked as events come in and, if the node has an event loop, on a
+    timer. Batches are always split by row so ``columnar`` is ignored.
+
     This node also keeps track of when and which data came through the
     node.
 
@@ -633,6 +1112,10 @@ class simple_from_event_stream(Stream):
             event_stream_name=ALL,
             stream_name=None,
             principle=False,
+            zero_copy=False,
+            columnar=False,
+            batch=None,
+            max_latency=None,
             **kwargs,
     ):
         asynchronous = None
@@ -648,7 +1131,20 @@ class simple_from_event_stream(Stream):
         if isinstance(data_address, str):
             data_address = tuple([data_address])
         self.data_address = data_address
+        self._get_data = compile_data_address(data_address)
         self.event_stream_name = event_stream_name
+        self.zero_copy = zero_copy
+        self.columnar = columnar
+        self.batch = batch
+        self.max_latency = max_latency
+        self._batching = batch is not None or max_latency is not None
+        self._batch_data = []
+        self._batch_uids = []
+        self._batch_time = None
+        # number of batches emitted, so timers know if their batch is gone
+        self._batch_count = 0
+        # the max_latency timer flushes from the loop's thread
+        self._batch_lock = threading.RLock()
         self.uid = str(uuid.uuid4())
         self.descriptor_uids = []
         self.subs = []
@@ -659,6 +1155,8 @@ class simple_from_event_stream(Stream):
     def update(self, x, who=None):
         name, doc = x
         if name == "start":
+            # Anything left over is from the last run
+            self.flush()
             self.start_uid = doc["uid"]
             # Sideband start document in
             [s.emit_start(x) for s in self.subs]
@@ -668,11 +1166,18 @@ class simple_from_event_stream(Stream):
         ):
             self.descriptor_uids.append(doc["uid"])
         if name == "stop":
+            self.flush()
             # Trigger the downstream nodes to make a stop but they can emit
             # on their own time
             self.descriptor_uids = []
             [s.emit_stop(x) for s in self.subs]
-        inner = doc.copy()
+        if name == "event_page":
+            if (
+                    self.doc_type == "event"
+                    and doc["descriptor"] in self.descriptor_uids
+            ):
+                return self._update_event_page(doc)
+            return
         if name == self.doc_type and (
                 (
                     name == "descriptor"
@@ -682,19 +1187,101 @@ class simple_from_event_stream(Stream):
                     and (doc["descriptor"] in self.descriptor_uids)
                 ) or name in ["start", "stop"]
         ):
+            if self.zero_copy:
+                inner = self._get_data(MappingProxyType(doc))
+                # Only copy what leaves the node so downstream nodes can't
+                # change the upstream documents
+                if isinstance(inner, Mapping):
+                    inner = dict(inner)
+            else:
+                inner = self._get_data(doc.copy())
+            if inner is _MISSING:
+                return
+            if name == "event" and self._batching:
+                return self._add_to_batch(inner, doc["uid"])
+            return self.emit(inner)
 
-            # If we have an empty address get everything
-            if self.data_address != ():
-                for da in self.data_address:
-                    # If it's a tuple we want multiple things at once
-                    if isinstance(da, tuple):
-                        inner = tuple(inner[daa] for daa in da)
-                    else:
-                        if da in inner:
-                            inner = inner[da]
-                        else:
-                            return
+    def _update_event_page(self, doc):
+        if self.columnar and not self._batching:
+            # The page is not mutated and the columns are new arrays so there
+            # is no need to copy here
+            inner = self._get_data(doc)
+            if inner is _MISSING:
+                return
+            if isinstance(inner, tuple):
+                inner = tuple(np.asarray(i) for i in inner)
+            elif isinstance(inner, Mapping):
+                inner = {k: np.asarray(v) for k, v in inner.items()}
+            else:
+                inner = np.asarray(inner)
             return self.emit(inner)
+        rl = []
+        # unpacking makes new documents for each row so there is no need to
+        # copy here
+        for event in unpack_event_page(doc):
+            inner = self._get_data(event)
+            if inner is _MISSING:
+                return rl
+            if self._batching:
+                rl.append(self._add_to_batch(inner, event["uid"]))
+            else:
+                rl.append(self.emit(inner))
+        return rl
+
+    def _add_to_batch(self, inner, uid):
+        now = time.time()
+        with self._batch_lock:
+            if not self._batch_data:
+                self._batch_time = now
+                if self.max_latency is not None and self.loop is not None:
+                    # add_callback is thread safe, call_later is not
+                    self.loop.add_callback(
+                        self.loop.call_later,
+                        self.max_latency,
+                        self._flush_batch,
+                        self._batch_count,
+                    )
+            self._batch_data.append(inner)
+            self._batch_uids.append(uid)
+            if (
+                    self.batch is not None
+                    and len(self._batch_data) >= self.batch
+            ) or (
+                    self.max_latency is not None
+                    and now - self._batch_time >= self.max_latency
+            ):
+                return self.flush()
+
+    def _flush_batch(self, batch_count):
+        with self._batch_lock:
+            # Only flush if the batch the timer was made for is still around
+            if batch_count == self._batch_count:
+                self.flush()
+
+    def memory_usage(self):
+        """The estimated memory (in bytes) used by the state of this node
+
+        Returns
+        -------
+        dict :
+            The size of each piece of state
+        """
+        return {
+            "descriptor_uids": sizeof(self.descriptor_uids),
+            "batch": sizeof(self._batch_data) + sizeof(self._batch_uids),
+        }
+
+    def flush(self):
+        """Emit the current batch, if there is one"""
+        # emit under the lock so the batches go out in order
+        with self._batch_lock:
+            if not self._batch_data:
+                return
+            data, uids = self._batch_data, self._batch_uids
+            self._batch_data = []
+            self._batch_uids = []
+            self._batch_count += 1
+            return self.emit((np.stack(data), uids))
 
 
 class SimpleFromEventStream(simple_from_event_stream):
@@ -706,6 +1293,10 @@ class SimpleFromEventStream(simple_from_event_stream):
             event_stream_name=ALL,
             stream_name=None,
             principle=False,
+            zero_copy=False,
+            columnar=False,
+            batch=None,
+            max_latency=None,
             **kwargs,
     ):
         simple_from_event_stream.__init__(
@@ -716,10 +1307,118 @@ class SimpleFromEventStream(simple_from_event_stream):
             event_stream_name=event_stream_name,
             stream_name=stream_name,
             principle=principle,
+            zero_copy=zero_copy,
+            columnar=columnar,
+            batch=batch,
+            max_latency=max_latency,
             **kwargs,
         )
 
 
+@Stream.register_api()
+class route_event_streams(Stream):
+    """Routes documents to only the ``FromEventStream`` nodes which use them.
+
+    Parameters
+    ----------
+    upstream : Stream instance or None, optional
+        The upstream node to receive documents from, defaults to None
+    stream_name : str, optional
+        Name for this stream node
+
+    Notes
+    -----
+    Start and stop documents go to all the downstream nodes. Descriptors only
+    go to the ``FromEventStream`` nodes which are listening to their event
+    stream and events (and event pages) only go to the ``FromEventStream``
+    nodes which extract from events of their event stream, so the cost of an
+    event scales with the number of interested nodes, rather than all the
+    nodes on the source.
+    Downstream nodes which are not ``FromEventStream`` nodes get all the
+    documents.
+
+    Examples
+    --------
+    >>> from rapidz import Stream
+    >>> from shed.simple import SimpleFromEventStream
+    >>> source = Stream()
+    >>> router = source.route_event_streams()
+    >>> a = SimpleFromEventStream('event', ('data', 'motor1'), router,
+    ...                           principle=True)
+    >>> b = SimpleFromEventStream('event', ('data', 'det'), router,
+    ...                           event_stream_name='baseline')
+    """
+
+    def __init__(self, upstream=None, stream_name=None, **kwargs):
+        Stream.__init__(self, upstream, stream_name=stream_name, **kwargs)
+        # map between descriptor uid and the nodes which want its events
+        self.event_routes = {}
+        self._targets = self.downstreams
+
+    def _routes(self, stream_name, doc_type=None):
+        return [
+            n
+            for n in self.downstreams
+            if not isinstance(n, simple_from_event_stream)
+            or (
+                n.event_stream_name in (ALL, stream_name)
+                and doc_type in (None, n.doc_type)
+            )
+        ]
+
+    def update(self, x, who=None):
+        name, doc = x
+        if name == "start":
+            self.event_routes.clear()
+            self._targets = self.downstreams
+        elif name == "descriptor":
+            stream_name = doc.get("name", "primary")
+            self.event_routes[doc["uid"]] = self._routes(stream_name, "event")
+            self._targets = self._routes(stream_name)
+        elif name in ("event", "event_page"):
+            self._targets = self.event_routes.get(doc["descriptor"])
+            # Only nodes which aren't FromEventStream nodes want events from
+            # unknown descriptors
+            if self._targets is None:
+                self._targets = [
+                    n
+                    for n in self.downstreams
+                    if not isinstance(n, simple_from_event_stream)
+                ]
+        else:
+            self._targets = self.downstreams
+        ret = self.emit(x)
+        if name == "stop":
+            self.event_routes.clear()
+        return ret
+
+    def memory_usage(self):
+        """The estimated memory (in bytes) used by the state of this node
+
+        Returns
+        -------
+        dict :
+            The size of each piece of state
+        """
+        return {"event_routes": sizeof(self.event_routes)}
+
+    def _emit(self, x):
+        result = []
+        for downstream in list(self._targets):
+            r = downstream.update(x, who=self)
+            if type(r) is list:
+                result.extend(r)
+            else:
+                result.append(r)
+
+        return [element for element in result if element is not None]
+
+
+@Stream.register_api()
+class RouteEventStreams(route_event_streams):
+    pass
+
+
 @Stream.register_api()
 class align_event_streams(szip):
     """Zips and aligns multiple streams of documents, note that the last
@@ -798,6 +1497,19 @@ class align_event_streams(szip):
                         b.clear()
             return ret
 
+    def memory_usage(self):
+        """The estimated memory (in bytes) used by the state of this node
+
+        Returns
+        -------
+        dict :
+            The size of each piece of state
+        """
+        return {
+            "descriptor_uids": sizeof(self.descriptor_uids),
+            "true_buffers": sizeof(self.true_buffers),
+        }
+
 
 @Stream.register_api()
 class AlignEventStreams(align_event_streams):
@@ -822,6 +1534,10 @@ class LastCache(Stream):
             }
         elif name == "event":
             self.last_caches[doc["descriptor"]]["doc"] = doc
+        elif name == "event_page":
+            # only the last row of the page is needed
+            *_, event = unpack_event_page(doc)
+            self.last_caches[doc["descriptor"]]["doc"] = event
         elif name == "stop":
             for descriptor_uid, cache in self.last_caches.items():
                 # if we don't have any docs in this stream do nothing
@@ -844,4 +1560,16 @@ class LastCache(Stream):
                             ),
                         )
                     )
+            # don't hold on to the data until the next run
+            self.last_caches = {}
         self.emit(x)
+
+    def memory_usage(self):
+        """The estimated memory (in bytes) used by the state of this node
+
+        Returns
+        -------
+        dict :
+            The size of each piece of state
+        """
+        return {"last_caches": sizeof(getattr(self, "last_caches", {}))}
@@ -1,12 +1,15 @@
 import uuid
 from collections import MutableMapping
 
-import networkx as nx
 from rapidz.clients import result_maybe
 from rapidz.core import move_to_first
 from rapidz.parallel import ParallelStream
 from shed.doc_gen import CreateDocs, get_dtype
-from shed.simple import walk_to_translation, SimpleFromEventStream
+from shed.simple import (
+    build_translation_graph,
+    SimpleFromEventStream,
+    sizeof,
+)
 
 
 @ParallelStream.register_api()
@@ -84,8 +87,7 @@ class SimpleToEventStream(ParallelStream, CreateDocs):
 
         # walk upstream to get all upstream nodes to the translation node
         # get start_uids from the translation node
-        self.graph = nx.DiGraph()
-        walk_to_translation(self, graph=self.graph)
+        self.graph = build_translation_graph(self)
 
         self.translation_nodes = {
             k: n["stream"]
@@ -129,6 +131,16 @@ class SimpleToEventStream(ParallelStream, CreateDocs):
         self.state = "stopped"
         return ret
 
+    def memory_usage(self):
+        """The estimated memory (in bytes) used by the state of this node
+
+        Returns
+        -------
+        dict :
+            The size of each piece of state
+        """
+        return {"event_buffer": sizeof(self.event_buffer)}
+
     def update(self, x, who=None):
         rl = []
         # If we have a start document ready to go, release it.
@@ -1,11 +1,19 @@
 import operator as op
+from concurrent.futures import ThreadPoolExecutor
 
 import networkx as nx
 import numpy as np
 import pytest
 from rapidz import Stream
 from shed import FromEventStream
-from shed.replay import replay
+from shed import replay as replay_module
+from shed.replay import (
+    IncrementalReplay,
+    clear_pipeline_cache,
+    replay,
+    replay_many,
+    replay_stream,
+)
 from shed.tests.utils import y
 from tornado import gen
 
@@ -63,6 +71,351 @@ def test_replay(db):
             assert nd1[1]["data"]["img2"] == nd2[1]["data"]["img2"]
 
 
+@pytest.mark.gen_test
+def test_replay_stream(db):
+    g1 = FromEventStream(
+        "event",
+        ("data", "det_image"),
+        principle=True,
+        stream_name="g1",
+        asynchronous=True,
+    )
+    g11 = FromEventStream(
+        "event", ("data", "det_image"), stream_name="g11", asynchronous=True
+    )
+    g2 = g1.combine_latest(g11, emit_on=0).starmap(op.add, stream_name="add")
+    g = g2.ToEventStream(("img2",))
+    graph = g.graph
+    dbf = g.DBFriendly()
+    l1 = dbf.sink_to_list()
+    dbf.starsink(db.insert)
+
+    # run the experiment
+    l0 = []
+    for yy in y(5):
+        l0.append(yy)
+        db.insert(*yy)
+        yield g11.update(yy)
+        yield g1.update(yy)
+
+    # generate the replay
+    lg, parents, docs = replay_stream(db, db[-1])
+
+    assert set(graph.nodes) == set(lg.nodes)
+    l2 = lg.nodes[list(nx.topological_sort(lg))[-1]]["stream"].sink_to_list()
+    # run the replay
+    seen = []
+    for node_uid, nd in docs:
+        seen.append(node_uid)
+        parents[node_uid].update(nd)
+
+    # both nodes share the raw header and get each document in turn
+    assert seen == [g11.uid, g1.uid] * len(l0)
+    assert len(l1) == len(l2)
+    assert len(l0) == len(l2)
+    for nd1, nd2 in zip(l0, l2):
+        assert nd1[0] == nd2[0]
+        if nd1[0] == "event":
+            assert nd1[1]["data"]["det_image"] * 2 == nd2[1]["data"]["img2"]
+    for nd1, nd2 in zip(l1, l2):
+        assert nd1[0] == nd2[0]
+        if nd1[0] == "event":
+            assert nd1[1]["data"]["img2"] == nd2[1]["data"]["img2"]
+
+
+def test_merged_documents_start_stop_only():
+    docs = list(y(5))
+    read = []
+
+    def documents():
+        for nd in docs:
+            read.append(nd)
+            yield nd
+
+    class FakeDB:
+        def __getitem__(self, uid):
+            return FakeHeader()
+
+    class FakeHeader:
+        def documents(self):
+            return documents()
+
+    start_uid = docs[0][1]["uid"]
+    times = [
+        {"time": i, "node": "all", "uid": d["uid"]}
+        for i, (n, d) in enumerate(docs)
+    ]
+    # this node only saw the start and the stop (eg. behind a router)
+    times += [
+        {"time": 0.5, "node": "start_stop", "uid": docs[0][1]["uid"]},
+        {"time": len(docs), "node": "start_stop", "uid": docs[-1][1]["uid"]},
+    ]
+    hdr = {
+        "start": {
+            "parent_node_map": {"all": start_uid, "start_stop": start_uid}
+        },
+        "stop": {"times": times},
+    }
+
+    merged = replay_module._merged_documents(FakeDB(), hdr)
+    out = []
+    for node_uid, nd in merged:
+        out.append((node_uid, nd[0]))
+        # the documents are read as they are needed, not buffered ahead
+        assert read[-1] is nd
+    assert out == [("all", "start"), ("start_stop", "start")] + [
+        ("all", n) for n, d in docs[1:]
+    ] + [("start_stop", "stop")]
+
+
+@pytest.mark.gen_test
+def test_incremental_replay(db):
+    g1 = FromEventStream(
+        "event",
+        ("data", "det_image"),
+        principle=True,
+        stream_name="g1",
+        asynchronous=True,
+    )
+    g2 = g1.map(op.mul, 5, stream_name="mul")
+    g3 = g2.map(op.add, 1, stream_name="add")
+    g = g3.ToEventStream(("img2",))
+    g.DBFriendly().starsink(db.insert)
+
+    l0 = []
+    for yy in y(5):
+        l0.append(yy)
+        db.insert(*yy)
+        yield g1.update(yy)
+
+    r = IncrementalReplay(db, db[-1])
+    assert set(g.graph.nodes) == set(r.graph.nodes)
+    l1 = r.graph.nodes[g1.uid]["stream"].sink_to_list()
+    l2 = r.graph.nodes[g.uid]["stream"].sink_to_list()
+
+    assert r.run() == set(r.graph.nodes)
+    assert len(l1) == 5
+    assert len(l2) == len(l0)
+    # nothing changed so nothing runs
+    assert r.run() == set()
+    assert len(l2) == len(l0)
+
+    r.graph.nodes[g3.uid]["stream"].args = (2,)
+    assert r.run() == {g3.uid, g.uid}
+    # the FromEventStream was not rerun
+    assert len(l1) == 5
+    assert len(l2) == 2 * len(l0)
+    for nd1, nd2 in zip(l0, l2[len(l0):]):
+        assert nd1[0] == nd2[0]
+        if nd1[0] == "event":
+            assert nd1[1]["data"]["det_image"] * 5 + 2 == (
+                nd2[1]["data"]["img2"]
+            )
+
+    r.graph.nodes[g2.uid]["stream"].args = (10,)
+    assert r.run() == {g2.uid, g3.uid, g.uid}
+    assert len(l1) == 5
+    for nd1, nd2 in zip(l0, l2[2 * len(l0):]):
+        assert nd1[0] == nd2[0]
+        if nd1[0] == "event":
+            assert nd1[1]["data"]["det_image"] * 10 + 2 == (
+                nd2[1]["data"]["img2"]
+            )
+
+
+@pytest.mark.gen_test
+def test_incremental_replay_state(db):
+    g1 = FromEventStream(
+        "event",
+        ("data", "det_image"),
+        principle=True,
+        stream_name="g1",
+        asynchronous=True,
+    )
+    g2 = g1.map(op.mul, 5, stream_name="mul")
+    g3 = g2.accumulate(op.add, start=0, stream_name="total")
+    g = g3.ToEventStream(("total",))
+    g.DBFriendly().starsink(db.insert)
+
+    for yy in y(5):
+        db.insert(*yy)
+        yield g1.update(yy)
+
+    r = IncrementalReplay(db, db[-1])
+    indexes = {s: s.__dict__.get("_translation_index") for s in r.streams}
+    l2 = r.graph.nodes[g.uid]["stream"].sink_to_list()
+    r.run()
+    totals = [d["data"]["total"] for n, d in l2 if n == "event"]
+    assert totals == [5, 15, 30, 50, 75]
+
+    # the running total starts over rather than carrying on from the last
+    # run
+    r.graph.nodes[g2.uid]["stream"].args = (10,)
+    assert r.run() == {g2.uid, g3.uid, g.uid}
+    totals = [d["data"]["total"] for n, d in l2 if n == "event"]
+    assert totals[5:] == [10, 30, 60, 100, 150]
+    # the nodes still share the pipeline's translation index
+    for s, index in indexes.items():
+        assert s.__dict__.get("_translation_index") is index
+
+
+@pytest.mark.gen_test
+def test_replay_many(db):
+    g1 = FromEventStream(
+        "event",
+        ("data", "det_image"),
+        principle=True,
+        stream_name="g1",
+        asynchronous=True,
+    )
+    g2 = g1.map(op.mul, 5, stream_name="mul")
+    g = g2.ToEventStream(("img2",))
+    g.DBFriendly().starsink(db.insert)
+
+    uids = []
+    for _ in range(3):
+        for yy in y(5):
+            db.insert(*yy)
+            yield g1.update(yy)
+        uids.append(db[-1].start["uid"])
+
+    progress = []
+    summary = replay_many(
+        db,
+        uids + ["not a uid"],
+        max_workers=2,
+        progress=lambda *x: progress.append(x),
+        executor=ThreadPoolExecutor(2),
+    )
+    assert len(progress) == 4
+    assert progress[-1][1:] == (4, 4)
+    assert summary["headers"] == 4
+    assert set(summary["failed"]) == {"not a uid"}
+    for result in summary["results"]:
+        if result["uid"] in uids:
+            assert result["error"] is None
+            # start, descriptor, 5 events, stop
+            assert result["documents"] == 8
+            assert result["outputs"] == 8
+    assert summary["documents"] == 3 * 8
+    assert summary["documents_per_second"] > 0
+    # the replays were inserted next to the original analysis
+    graph_hash = db[uids[0]].start["graph_hash"]
+    assert len(list(db(graph_hash=graph_hash))) == 2 * len(uids)
+
+
+@pytest.mark.gen_test
+def test_pipeline_cache(db, monkeypatch):
+    g1 = FromEventStream(
+        "event",
+        ("data", "det_image"),
+        principle=True,
+        stream_name="g1",
+        asynchronous=True,
+    )
+    g2 = g1.map(op.mul, 5, stream_name="mul")
+    g = g2.ToEventStream(("img2",))
+    g.DBFriendly().starsink(db.insert)
+
+    hdrs = []
+    for _ in range(2):
+        for yy in y(5):
+            db.insert(*yy)
+            yield g1.update(yy)
+        hdrs.append(db[-1])
+
+    clear_pipeline_cache()
+    templates = []
+    template_init = replay_module._PipelineTemplate.__init__
+
+    def counting_init(self, graph):
+        templates.append(self)
+        template_init(self, graph)
+
+    monkeypatch.setattr(
+        replay_module._PipelineTemplate, "__init__", counting_init
+    )
+
+    lg1, parents1, data1, vs1 = replay(db, hdrs[0])
+    lg2, parents2, data2, vs2 = replay(db, hdrs[1])
+    # both headers come from the same pipeline so it is only parsed once
+    assert len(templates) == 1
+    # but each replay gets its own nodes
+    for n in lg1.nodes:
+        assert lg1.nodes[n]["stream"] is not lg2.nodes[n]["stream"]
+
+    l1 = lg1.nodes[g.uid]["stream"].sink_to_list()
+    l2 = lg2.nodes[g.uid]["stream"].sink_to_list()
+    for v in vs1:
+        parents1[v["node"]].update(data1[v["uid"]])
+    assert len(l1) == 8
+    assert l2 == []
+    for v in vs2:
+        parents2[v["node"]].update(data2[v["uid"]])
+    assert len(l2) == 8
+
+    clear_pipeline_cache()
+    replay(db, hdrs[0])
+    assert len(templates) == 2
+
+    # the least recently used pipelines are dropped
+    clear_pipeline_cache()
+    monkeypatch.setattr(replay_module, "_pipeline_cache_size", 1)
+    replay_module._pipeline_cache["other"] = templates[0]
+    replay(db, hdrs[0])
+    assert len(templates) == 3
+    assert "other" not in replay_module._pipeline_cache
+    assert len(replay_module._pipeline_cache) == 1
+
+
+@pytest.mark.gen_test
+def test_pipeline_cache_instances(db, monkeypatch):
+    # the same pipeline built twice (eg. in two sessions) has new node ids
+    hdrs = []
+    for _ in range(2):
+        g1 = FromEventStream(
+            "event",
+            ("data", "det_image"),
+            principle=True,
+            stream_name="g1",
+            asynchronous=True,
+        )
+        g2 = g1.map(op.mul, 5, stream_name="mul")
+        g = g2.ToEventStream(("img2",))
+        g.DBFriendly().starsink(db.insert)
+        for yy in y(5):
+            db.insert(*yy)
+            yield g1.update(yy)
+        hdrs.append(db[-1])
+    assert hdrs[0].start["graph_hash"] == hdrs[1].start["graph_hash"]
+    assert hdrs[0].start["graph"] != hdrs[1].start["graph"]
+
+    clear_pipeline_cache()
+    templates = []
+    template_init = replay_module._PipelineTemplate.__init__
+
+    def counting_init(self, graph):
+        templates.append(self)
+        template_init(self, graph)
+
+    monkeypatch.setattr(
+        replay_module._PipelineTemplate, "__init__", counting_init
+    )
+    for hdr in hdrs:
+        lg, parents, docs = replay_stream(db, hdr)
+        # the nodes have the ids of the header
+        assert set(lg.nodes) == {n["id"] for n in hdr.start["graph"]["nodes"]}
+        outbound = lg.nodes[hdr.start["outbound_node"]]["stream"]
+        out = outbound.sink_to_list()
+        for node_uid, nd in docs:
+            parents[node_uid].update(nd)
+        assert [d["data"]["img2"] for n, d in out if n == "event"] == [
+            5, 10, 15, 20, 25
+        ]
+    # the pipeline is only parsed once
+    assert len(templates) == 1
+
+
 @pytest.mark.gen_test
 def test_replay_dummy_node(db):
     # XXX: what to do if you have a source?
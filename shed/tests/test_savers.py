@@ -0,0 +1,109 @@
+import time
+
+import numpy as np
+import pytest
+from shed.savers import NpyWriter
+
+
+class FakeRegistry:
+    def __init__(self):
+        self.resources = {}
+        self.datums = {}
+
+    def insert_resource(self, spec, resource_path, resource_kwargs,
+                        root=None, uid=None):
+        if uid is None:
+            uid = str(len(self.resources))
+        resource = dict(spec=spec, resource_path=resource_path,
+                        resource_kwargs=resource_kwargs, root=root, uid=uid)
+        self.resources[uid] = resource
+        return resource
+
+    def insert_datum(self, resource, datum_id, datum_kwargs):
+        self.datums[datum_id] = dict(resource=resource["uid"],
+                                     datum_kwargs=datum_kwargs)
+
+
+def check_datums(fs, datum_ids):
+    assert set(fs.datums) == set(datum_ids)
+    for datum_id in datum_ids:
+        assert fs.datums[datum_id]["resource"] in fs.resources
+
+
+def test_npy_writer(tmpdir):
+    fs = FakeRegistry()
+    with NpyWriter(fs, str(tmpdir)) as w:
+        datum_ids = [w.write(np.ones(3) * i) for i in range(3)]
+        check_datums(fs, datum_ids)
+    with pytest.raises(RuntimeError):
+        w.write(np.ones(3))
+
+
+def test_buffered_npy_writer(tmpdir):
+    fs = FakeRegistry()
+    with NpyWriter(fs, str(tmpdir), buffered=True, max_buffer=5) as w:
+        datum_ids = [w.write(np.ones(3) * i) for i in range(4)]
+        assert fs.datums == {}
+        # the fifth write fills the buffer
+        datum_ids.append(w.write(np.ones(3)))
+        check_datums(fs, datum_ids)
+        datum_ids.append(w.write(np.ones(3)))
+        assert len(fs.datums) == 5
+    # closing flushes the rest
+    check_datums(fs, datum_ids)
+
+
+def test_buffered_npy_writer_interval(tmpdir):
+    fs = FakeRegistry()
+    w = NpyWriter(fs, str(tmpdir), buffered=True, flush_interval=0)
+    datum_id = w.write(np.ones(3))
+    check_datums(fs, [datum_id])
+    w.close()
+
+
+def test_background_npy_writer(tmpdir):
+    fs = FakeRegistry()
+    w = NpyWriter(fs, str(tmpdir), background=True, flush_interval=.01)
+    datum_ids = [w.write(np.ones(3) * i) for i in range(3)]
+    for _ in range(100):
+        if len(fs.datums) == 3:
+            break
+        time.sleep(.01)
+    check_datums(fs, datum_ids)
+    datum_ids.append(w.write(np.ones(3)))
+    w.close()
+    check_datums(fs, datum_ids)
+
+
+def test_background_npy_writer_error(tmpdir):
+    fs = FakeRegistry()
+    insert_resource = fs.insert_resource
+    insert_datum = fs.insert_datum
+    resource_calls = []
+    datum_calls = []
+
+    def count_resource(*args, **kwargs):
+        resource_calls.append(args)
+        return insert_resource(*args, **kwargs)
+
+    def fail_once(*args, **kwargs):
+        datum_calls.append(args)
+        if len(datum_calls) == 1:
+            raise ValueError("no registry")
+        return insert_datum(*args, **kwargs)
+
+    fs.insert_resource = count_resource
+    fs.insert_datum = fail_once
+    w = NpyWriter(fs, str(tmpdir), background=True, flush_interval=.01)
+    datum_id = w.write(np.ones(3))
+    for _ in range(100):
+        if fs.datums:
+            break
+        time.sleep(.01)
+    # the error from the flusher is raised in the writer's thread
+    with pytest.raises(ValueError):
+        w.close()
+    # the failed datum is inserted on a later flush, without reinserting
+    # its resource
+    check_datums(fs, [datum_id])
+    assert len(resource_calls) == 1
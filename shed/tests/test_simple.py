@@ -1,4 +1,7 @@
+import copy
 import operator as op
+import sys
+import threading
 import time
 import uuid
 
@@ -6,6 +9,7 @@ import networkx as nx
 import numpy as np
 import pytest
 from bluesky.plan_stubs import checkpoint, abs_set, trigger_and_read
+from event_model import pack_event_page
 from bluesky.plans import scan, count
 from shed import (
     SimpleFromEventStream as FromEventStream,
@@ -13,7 +17,14 @@ from shed import (
     walk_to_translation,
     simple_to_event_stream_new_api,
 )
-from shed.simple import _hash_or_uid, build_upstream_node_set
+from shed.simple import (
+    _hash_or_uid,
+    _MISSING,
+    build_upstream_node_set,
+    build_translation_graph,
+    compile_data_address,
+    sizeof,
+)
 from shed.tests.utils import y
 from shed.utils import unstar
 from rapidz import Stream, move_to_first
@@ -82,6 +93,173 @@ def test_from_event_model_all(RE, hw):
         assert i == ll["data"]["motor"]
 
 
+def test_compile_data_address():
+    doc = {"data": {"motor": 1, "det": 2}, "uid": "hi"}
+    assert compile_data_address(())(doc) is doc
+    assert compile_data_address(("data", "motor"))(doc) == 1
+    assert compile_data_address(("data",))(doc) is doc["data"]
+    assert compile_data_address(("data", ("motor", "det")))(doc) == (1, 2)
+    assert compile_data_address(("data", "img"))(doc) is _MISSING
+    assert compile_data_address(("img", "motor"))(doc) is _MISSING
+    assert compile_data_address(("uid",))(doc) == "hi"
+
+
+def test_from_event_model_missing_key(RE, hw):
+    source = Stream()
+    t = FromEventStream("event", ("data", "img"), source, principle=True)
+    L = t.sink_to_list()
+
+    RE.subscribe(unstar(source.emit))
+
+    RE(scan([hw.motor], hw.motor, 0, 9, 10))
+
+    assert L == []
+
+
+def test_from_event_model_zero_copy():
+    source = Stream()
+    t = FromEventStream(
+        "event", ("data",), source, principle=True, zero_copy=True
+    )
+    t2 = FromEventStream("start", (), source, zero_copy=True)
+    t3 = FromEventStream(
+        "event", ("data", "det_image"), source, zero_copy=True
+    )
+    L = t.sink_to_list()
+    L2 = t2.sink_to_list()
+    L3 = t3.sink_to_list()
+    # try to clobber the upstream documents
+    t.sink(lambda x: x.update(det_image="clobbered"))
+    t2.sink(lambda x: x.update(uid="clobbered"))
+
+    docs = list(y(5))
+    original_docs = copy.deepcopy(docs)
+    for nd in docs:
+        source.emit(nd)
+
+    assert docs == original_docs
+    assert len(L) == 5
+    assert all(ll["det_image"] == "clobbered" for ll in L)
+    assert L2[0]["uid"] == "clobbered"
+    assert L3 == [1, 2, 3, 4, 5]
+
+
+def test_from_event_model_event_page():
+    source = Stream()
+    rows = FromEventStream(
+        "event", ("data", "det_image"), source, principle=True
+    )
+    columns = FromEventStream(
+        "event", ("data", "det_image"), source, columnar=True
+    )
+    multi_columns = FromEventStream(
+        "event", ("data", ("det_image", "det_image")), source, columnar=True
+    )
+    starts = FromEventStream("start", ("uid",), source)
+    L_rows = rows.sink_to_list()
+    L_columns = columns.sink_to_list()
+    L_multi_columns = multi_columns.sink_to_list()
+    L_starts = starts.sink_to_list()
+
+    docs = list(y(5))
+    start, descriptor, events, stop = docs[0], docs[1], docs[2:-1], docs[-1]
+    page = pack_event_page(*[doc for _, doc in events])
+    for nd in [start, descriptor, ("event_page", page), stop]:
+        source.emit(nd)
+
+    assert L_rows == [1, 2, 3, 4, 5]
+    assert len(L_columns) == 1
+    assert isinstance(L_columns[0], np.ndarray)
+    np.testing.assert_array_equal(L_columns[0], [1, 2, 3, 4, 5])
+    assert len(L_multi_columns[0]) == 2
+    np.testing.assert_array_equal(L_multi_columns[0][1], [1, 2, 3, 4, 5])
+    assert len(L_starts) == 1
+
+    # pages from other descriptors are ignored
+    L_rows.clear()
+    page["descriptor"] = "not a descriptor"
+    for nd in [start, descriptor, ("event_page", page), stop]:
+        source.emit(nd)
+    assert L_rows == []
+
+
+def test_from_event_model_batch():
+    source = Stream()
+    t = FromEventStream(
+        "event", ("data", "det_image"), source, principle=True, batch=2
+    )
+    L = t.sink_to_list()
+
+    docs = list(y(5))
+    for nd in docs:
+        source.emit(nd)
+
+    uids = [doc["uid"] for name, doc in docs if name == "event"]
+    assert len(L) == 3
+    for (data, batch_uids), ex_data, ex_uids in zip(
+        L, [[1, 2], [3, 4], [5]], [uids[:2], uids[2:4], uids[4:]]
+    ):
+        assert isinstance(data, np.ndarray)
+        np.testing.assert_array_equal(data, ex_data)
+        assert batch_uids == ex_uids
+
+    # event pages are batched by row
+    L.clear()
+    page = pack_event_page(*[doc for name, doc in docs if name == "event"])
+    for nd in [docs[0], docs[1], ("event_page", page), docs[-1]]:
+        source.emit(nd)
+    assert [len(uids) for _, uids in L] == [2, 2, 1]
+
+
+def test_from_event_model_batch_threads():
+    source = Stream()
+    t = FromEventStream(
+        "event", ("data", "det_image"), source, principle=True, batch=100
+    )
+    L = t.sink_to_list()
+
+    docs = list(y(2000))
+    events = docs[2:-1]
+    done = threading.Event()
+
+    def flush():
+        # like the max_latency timer on the loop's thread
+        while not done.is_set():
+            t.flush()
+
+    thread = threading.Thread(target=flush)
+    thread.start()
+    for nd in docs[:-1]:
+        source.emit(nd)
+    done.set()
+    thread.join()
+    source.emit(docs[-1])
+
+    # no rows are lost or repeated
+    assert [u for _, uids in L for u in uids] == [
+        doc["uid"] for name, doc in events
+    ]
+    assert [d for data, _ in L for d in data] == list(range(1, 2001))
+
+
+def test_from_event_model_max_latency():
+    source = Stream()
+    t = FromEventStream(
+        "event",
+        ("data", "det_image"),
+        source,
+        principle=True,
+        max_latency=0,
+    )
+    L = t.sink_to_list()
+
+    for nd in y(5):
+        source.emit(nd)
+
+    assert len(L) == 5
+    assert [data.tolist() for data, _ in L] == [[1], [2], [3], [4], [5]]
+
+
 def test_from_event_model_stream_syntax(RE, hw):
     source = Stream()
     t = source.simple_from_event_stream(
@@ -193,6 +371,62 @@ def test_from_event_model_stream_name2():
         assert i + 100 == ll
 
 
+def test_route_event_streams():
+    def data():
+        suid = str(uuid.uuid4())
+        duid = str(uuid.uuid4())
+        duid2 = str(uuid.uuid4())
+        yield "start", {"hi": "world", "uid": suid}
+        yield "descriptor", {
+            "name": "hi",
+            "data_keys": {"ct"},
+            "uid": duid,
+            "run_start": suid,
+        }
+        yield "descriptor", {
+            "name": "not hi",
+            "data_keys": {"ct"},
+            "uid": duid2,
+            "run_start": suid,
+        }
+        for i in range(10):
+            for d, offset in [(duid, 0), (duid2, 100)]:
+                yield "event", {
+                    "uid": str(uuid.uuid4()),
+                    "data": {"ct": i + offset},
+                    "descriptor": d,
+                }
+        yield "stop", {"uid": str(uuid.uuid4()), "run_start": suid}
+
+    source = Stream()
+    router = source.route_event_streams()
+    hi = FromEventStream(
+        "event", ("data", "ct"), router, event_stream_name="hi"
+    )
+    not_hi = FromEventStream(
+        "event", ("data", "ct"), router, event_stream_name="not hi"
+    )
+    everything = FromEventStream("event", ("data", "ct"), router)
+    start = FromEventStream("start", ("hi",), router, principle=True)
+    L_hi = hi.sink_to_list()
+    L_not_hi = not_hi.sink_to_list()
+    L_all = everything.sink_to_list()
+    L_start = start.sink_to_list()
+    L_docs = router.sink_to_list()
+
+    docs = list(data())
+    for nd in docs:
+        source.emit(nd)
+
+    assert L_hi == list(range(10))
+    assert L_not_hi == list(range(100, 110))
+    assert len(L_all) == 20
+    assert L_start == ["world"]
+    # Nodes which aren't FromEventStream nodes get all the documents
+    assert L_docs == docs
+    assert not router.event_routes
+
+
 def test_walk_up():
     raw = Stream()
     a_translation = FromEventStream("start", ("time",), raw, principle=True)
@@ -232,6 +466,45 @@ def test_walk_up_partial():
     assert {_hash_or_uid(k) for k in s} == set(g.nodes)
 
 
+def test_shared_translation_graph():
+    raw = Stream()
+    a_translation = FromEventStream("start", ("time",), raw, principle=True)
+    b_translation = FromEventStream("event", ("data", "pe1_image"), raw)
+
+    d = b_translation.zip_latest(a_translation).map(op.truediv)
+    outputs = []
+    for i in range(20):
+        if i == 10:
+            ddd = ToEventStream(d, ("data",))
+            outputs.append(ddd)
+        o = ToEventStream(d.map(op.mul, i), ("data",))
+        outputs.append(o)
+
+        # the shared walk finds the same graph as walking from scratch
+        g = nx.DiGraph()
+        walk_to_translation(o, g)
+        assert set(o.graph.nodes) == set(g.nodes)
+        assert set(o.graph.edges) == set(g.edges)
+        for n, attrs in o.graph.nodes.items():
+            assert attrs["stream"] is g.nodes[n]["stream"]
+
+    index = d._translation_index
+    assert all(o._translation_index is index for o in outputs)
+    # the outputs after ddd stop at it
+    assert _hash_or_uid(ddd) in outputs[-1].graph
+    assert _hash_or_uid(ddd) not in outputs[0].graph
+
+
+def test_translation_graph_deep():
+    raw = Stream()
+    s = FromEventStream("event", ("data", "motor"), raw, principle=True)
+    for i in range(5000):
+        s = s.map(op.add, 1)
+    t = ToEventStream(s, ("motor",))
+    assert len(t.graph) == 5000 + 2
+    assert len(build_translation_graph(t).edges) == 5000 + 1
+
+
 def test_to_event_model(RE, hw):
     source = Stream()
     t = FromEventStream("event", ("data", "motor"), source, principle=True)
@@ -276,6 +549,76 @@ def test_to_event_model_stream_syntax(RE, hw):
     assert d[-1]["run_start"]
 
 
+def test_to_event_model_event_page():
+    source = Stream()
+    t = FromEventStream("event", ("data", "det_image"), source, principle=True)
+    n = ToEventStream(t, ("ct",), event_page_size=2)
+    p = n.pluck(0).sink_to_list()
+    d = n.pluck(1).sink_to_list()
+
+    for nd in y(5):
+        source.emit(nd)
+
+    assert p == [
+        "start",
+        "descriptor",
+        "event_page",
+        "event_page",
+        "event_page",
+        "stop",
+    ]
+    assert [dd["data"]["ct"] for dd in d[2:-1]] == [[1, 2], [3, 4], [5]]
+    assert [dd["seq_num"] for dd in d[2:-1]] == [[1, 2], [3, 4], [5]]
+    assert all(dd["descriptor"] == d[1]["uid"] for dd in d[2:-1])
+    assert d[-1]["num_events"] == {"primary": 5}
+
+
+def test_to_event_model_event_page_interval():
+    source = Stream()
+    t = FromEventStream("event", ("data", "det_image"), source, principle=True)
+    n = ToEventStream(t, ("ct",), event_page_interval=1e6)
+    p = n.pluck(0).sink_to_list()
+    d = n.pluck(1).sink_to_list()
+
+    for nd in y(5):
+        source.emit(nd)
+
+    # everything is flushed at the stop
+    assert p == ["start", "descriptor", "event_page", "stop"]
+    assert d[2]["data"]["ct"] == [1, 2, 3, 4, 5]
+
+
+def test_to_event_model_event_page_threads():
+    source = Stream()
+    t = FromEventStream("event", ("data", "det_image"), source, principle=True)
+    n = ToEventStream(t, ("ct",), event_page_size=100)
+    d = n.pluck(1).sink_to_list()
+    p = n.pluck(0).sink_to_list()
+    done = threading.Event()
+
+    def flush():
+        # like the event_page_interval timer on the loop's thread
+        while not done.is_set():
+            n.emit_event_page()
+
+    docs = list(y(2000))
+    source.emit(docs[0])
+    source.emit(docs[1])
+    thread = threading.Thread(target=flush)
+    thread.start()
+    for nd in docs[2:-1]:
+        source.emit(nd)
+    done.set()
+    thread.join()
+    source.emit(docs[-1])
+
+    # no events are lost or repeated
+    pages = [dd for pp, dd in zip(p, d) if pp == "event_page"]
+    assert [c for page in pages for c in page["data"]["ct"]] == list(
+        range(1, 2001)
+    )
+
+
 def test_align():
     a = Stream()
     b = Stream()
@@ -708,6 +1051,40 @@ def test_last_cache(RE, hw):
     assert docs[-1]["run_start"]
 
 
+def test_sizeof():
+    a = np.ones(1000)
+    assert sizeof(a) >= a.nbytes
+    assert sizeof({"a": [a, a]}) < 2 * a.nbytes
+    # the nodes are not counted, only the list holding them
+    assert sizeof([Stream()]) == sys.getsizeof([None])
+
+
+def test_memory_usage(RE, hw):
+    source = Stream()
+    router = source.RouteEventStreams()
+    t = FromEventStream("event", ("data", "motor"), router, principle=True)
+    n = ToEventStream(t, ("ct",))
+    lc = n.LastCache()
+    a = source.AlignEventStreams(n)
+    nodes = [router, t, n, lc, a]
+    for node in nodes:
+        node.sink(lambda x: None)
+
+    RE.subscribe(unstar(source.emit))
+
+    RE(scan([hw.motor], hw.motor, 0, 9, 10))
+    usage = [node.memory_usage() for node in nodes]
+    for u in usage:
+        assert all(isinstance(v, int) for v in u.values())
+    # the last event isn't held on to after the run
+    assert lc.last_caches == {}
+
+    # the state doesn't grow run over run
+    for i in range(3):
+        RE(scan([hw.motor], hw.motor, 0, 9, 10))
+    assert [node.memory_usage() for node in nodes] == usage
+
+
 def test_build_upstream_node_set():
     source = Stream()
     t = FromEventStream("event", ("data", "motor"), source, principle=True)
@@ -1,13 +1,25 @@
+import copy
 import operator as op
+import threading
 import time
 import uuid
 
 import networkx as nx
 import numpy as np
 from bluesky.plans import scan
+from event_model import pack_event_page
 from rapidz import Stream
+from shed import translation
 from shed.simple import walk_to_translation, _hash_or_uid
-from shed.translation import FromEventStream, ToEventStream, merkle_hash
+from shed.translation import (
+    FromEventStream,
+    ToEventStream,
+    merkle_hash,
+    TimeLog,
+    get_env_data,
+    refresh_env_data,
+)
+from shed.tests.utils import y
 from shed.utils import unstar
 from databroker import Broker
 
@@ -121,6 +133,133 @@ def test_from_event_model_stream_name2():
         assert i + 100 == ll
 
 
+def test_from_event_model_zero_copy():
+    t = FromEventStream("event", ("data",), principle=True, zero_copy=True)
+    n = ToEventStream(t.pluck("det_image"), ("out",))
+    d = n.pluck(1).sink_to_list()
+    # try to clobber the upstream documents
+    t.sink(lambda x: x.update(det_image="clobbered"))
+
+    docs = list(y(5))
+    original_docs = copy.deepcopy(docs)
+    for nd in docs:
+        t.update(nd)
+
+    assert docs == original_docs
+    assert [dd["data"]["out"] for dd in d[2:-1]] == [1, 2, 3, 4, 5]
+    assert len(t.times) == len(docs)
+
+
+def test_from_event_model_event_page():
+    t = FromEventStream("event", ("data", "det_image"), principle=True)
+    n = ToEventStream(t, ("out",))
+    d = n.pluck(1).sink_to_list()
+
+    docs = list(y(5))
+    start, descriptor, events, stop = docs[0], docs[1], docs[2:-1], docs[-1]
+    page = pack_event_page(*[doc for _, doc in events])
+    for nd in [start, descriptor, ("event_page", page), stop]:
+        t.update(nd)
+
+    assert [dd["data"]["out"] for dd in d[2:-1]] == [1, 2, 3, 4, 5]
+    # each row of the page is tracked
+    assert [uid for _, uid in t.times] == [
+        doc["uid"] for _, doc in docs
+    ]
+
+
+def test_route_event_streams(RE, hw):
+    source = Stream()
+    router = source.route_event_streams()
+    t = FromEventStream("event", ("data", "motor"), router, principle=True)
+    t2 = FromEventStream(
+        "event", ("data", "motor"), router, event_stream_name="baseline"
+    )
+    t3 = FromEventStream("start", ("uid",), router)
+    L = t.sink_to_list()
+    L2 = t2.sink_to_list()
+
+    RE.subscribe(unstar(source.emit))
+
+    RE(scan([hw.motor], hw.motor, 0, 9, 10))
+
+    assert L == list(range(10))
+    assert L2 == []
+    # start, descriptor, 10 events and stop
+    assert len(t.times) == 13
+    # start and stop only, the descriptor and events are not routed here
+    assert len(t2.times) == 2
+    # start, descriptor and stop
+    assert len(t3.times) == 3
+
+
+def test_time_log():
+    log = TimeLog(size=2)
+    entries = [(1.0, "a"), (2.0, "b"), (3.0, "b"), (4.0, "c"), (5.0, "a")]
+    log.extend(entries)
+    assert len(log) == 5
+    assert list(log) == entries
+    # runs of the same uid are only stored once
+    assert len(log._uids) == 4
+    assert log.export("node") == [
+        {"time": t, "node": "node", "uid": uid} for t, uid in entries
+    ]
+    log.clear()
+    assert len(log) == 0
+    assert list(log) == []
+    assert log.nbytes == 2 * 2 * 8
+
+
+def test_env_data_cache(tmpdir, monkeypatch):
+    calls = []
+
+    def conda_env():
+        calls.append(1)
+        return {"packages": ["shed"]}
+
+    monkeypatch.setattr(translation, "conda_env", conda_env)
+    monkeypatch.setattr(translation, "_env_data", None)
+    monkeypatch.setenv("SHED_CACHE_DIR", str(tmpdir))
+
+    assert get_env_data() == {"packages": ["shed"]}
+    assert get_env_data() == {"packages": ["shed"]}
+    assert len(calls) == 1
+    assert len(tmpdir.listdir()) == 1
+
+    # a new process reads the cache from disk
+    monkeypatch.setattr(translation, "_env_data", None)
+    assert get_env_data() == {"packages": ["shed"]}
+    assert len(calls) == 1
+
+    get_env_data(refresh=True)
+    assert len(calls) == 2
+    refresh_env_data().join()
+    assert len(calls) == 3
+
+
+def test_env_data_refresh_does_not_block(tmpdir, monkeypatch):
+    release = threading.Event()
+
+    def conda_env():
+        release.wait(10)
+        return {"packages": ["new"]}
+
+    monkeypatch.setattr(translation, "_env_data", None)
+    monkeypatch.setenv("SHED_CACHE_DIR", str(tmpdir))
+    monkeypatch.setattr(
+        translation, "conda_env", lambda: {"packages": ["old"]}
+    )
+    assert get_env_data() == {"packages": ["old"]}
+
+    monkeypatch.setattr(translation, "conda_env", conda_env)
+    thread = refresh_env_data()
+    # the cached data is served while the refresh runs
+    assert get_env_data() == {"packages": ["old"]}
+    release.set()
+    thread.join()
+    assert get_env_data() == {"packages": ["new"]}
+
+
 def test_walk_up():
     raw = Stream()
     a_translation = FromEventStream("start", ("time",), raw, principle=True)
@@ -378,6 +517,39 @@ def test_merkle_hash():
     assert order_1_hash != order_3_hash
 
 
+def test_merkle_hash_cache(monkeypatch):
+    calls = []
+    merkle_friendly_node = translation.merkle_friendly_node
+
+    def counting_merkle_friendly_node(node):
+        calls.append(node)
+        return merkle_friendly_node(node)
+
+    monkeypatch.setattr(
+        translation, "merkle_friendly_node", counting_merkle_friendly_node
+    )
+
+    source = Stream()
+    t = FromEventStream("event", ("data", "motor"), source, principle=True)
+    # diamond, the shared ancestor is only hashed once
+    z = t.map(op.add, 1)
+    zz = t.map(op.sub, 1)
+    n = ToEventStream(z.zip(zz).starmap(op.mul), ("ct",))
+
+    h = merkle_hash(n)
+    assert len(calls) == len(set(calls)) == 6
+
+    # nothing changed so nothing is rebuilt
+    assert merkle_hash(n) == h
+    assert len(calls) == 6
+
+    # changing the args invalidates only that node
+    z.args = (2,)
+    assert merkle_hash(n) != h
+    assert len(calls) == 7
+    assert calls[-1] is z
+
+
 def test_dbfriendly(RE, hw):
     source = Stream()
     t = FromEventStream("event", ("data", "motor"), source, principle=True)
@@ -409,6 +581,62 @@ def test_dbfriendly(RE, hw):
     assert len(d) == 10 + 3
 
 
+def test_dbfriendly_cache(RE, hw, monkeypatch):
+    calls = []
+    db_friendly_node = translation.db_friendly_node
+
+    def counting_db_friendly_node(node):
+        calls.append(node)
+        return db_friendly_node(node)
+
+    monkeypatch.setattr(
+        translation, "db_friendly_node", counting_db_friendly_node
+    )
+
+    source = Stream()
+    t = FromEventStream("event", ("data", "motor"), source, principle=True)
+    z = t.map(op.add, 1)
+    n = ToEventStream(z, "out").DBFriendly()
+    d = n.pluck(1).sink_to_list()
+
+    RE.subscribe(unstar(source.emit))
+
+    RE(scan([hw.motor], hw.motor, 0, 9, 10))
+    assert len(calls) == 3
+    g1, h1 = d[0]["graph"], d[0]["graph_hash"]
+
+    # nothing changed, the serialized graph is reused
+    d.clear()
+    RE(scan([hw.motor], hw.motor, 0, 9, 10))
+    assert len(calls) == 3
+    assert d[0]["graph"] == g1
+    assert d[0]["graph_hash"] == h1
+
+    # each start document gets its own copy of the top of the graph, the
+    # serialized nodes are shared so a start document costs the same
+    # whatever the nodes hold
+    assert d[0]["graph"] is not g1
+    assert d[0]["graph"]["nodes"] is not g1["nodes"]
+    for node, node1 in zip(d[0]["graph"]["nodes"], g1["nodes"]):
+        assert node is not node1
+        assert node["stream"] is node1["stream"]
+    d[0]["graph"]["nodes"][0]["note"] = "annotated"
+    d[0]["graph"]["nodes"].clear()
+    d.clear()
+    RE(scan([hw.motor], hw.motor, 0, 9, 10))
+    assert len(calls) == 3
+    assert d[0]["graph"] == g1
+
+    # only the changed node is re-serialized
+    d.clear()
+    z.args = (2,)
+    RE(scan([hw.motor], hw.motor, 0, 9, 10))
+    assert len(calls) == 4
+    assert calls[-1] is z
+    assert d[0]["graph"] != g1
+    assert d[0]["graph_hash"] != h1
+
+
 def test_db_insertion(RE, hw):
     db = Broker.named("temp")
 
@@ -1,7 +1,21 @@
+import os
+
 import bluesky.plans as bp
-from event_model import Filler
+import numpy as np
+import pytest
+from event_model import Filler, compose_run
 from rapidz import Stream
-from shed.writers import NpyWriter
+from shed.simple import FromEventStream, ToEventStream
+from shed.tests.utils import y
+from shed.writers import (
+    ExternalPolicy,
+    NpyStackHandler,
+    NpyWriter,
+    StackedNpyWriter,
+    content_hash,
+    handler_registry,
+    mmap_cache,
+)
 
 
 def test_storage(RE, hw, db, tmpdir):
@@ -39,6 +53,17 @@ def test_double_storage(RE, hw, db, tmpdir):
         source.emit(nd1)
         source.emit(nd2)
 
+    # the descriptors are dropped with their run
+    assert z.descriptors == {}
+    assert z.init_writers == {}
+    assert set(z.memory_usage()) == {
+        "init_writers",
+        "descriptors",
+        "not_issued_descriptors",
+        "datum_buffer",
+        "event_buffer",
+    }
+
     rt = Filler(handler_registry=db.reg.handler_reg)
     for ii in [-2, -1]:
         for i, nd in enumerate(db[ii].documents()):
@@ -47,3 +72,288 @@ def test_double_storage(RE, hw, db, tmpdir):
             if n2 == "event":
                 print(d2["data"]["img"])
                 assert d2["data"]["img"].shape == (10, 10)
+
+
+def test_stacked_storage(RE, hw, db, tmpdir):
+    db.reg.register_handler("npy_stack", NpyStackHandler)
+    source = Stream()
+    z = source.Store(str(tmpdir), StackedNpyWriter)
+    z.starsink(db.insert)
+    L = z.sink_to_list()
+
+    RE.subscribe(lambda *x: source.emit(x))
+    RE(bp.count([hw.direct_img], 5))
+
+    # one resource (and file) for the run, one datum per frame
+    assert [n for n, d in L].count("resource") == 1
+    assert [n for n, d in L].count("datum") == 5
+    assert len(os.listdir(os.path.join(str(tmpdir), "an_data"))) == 1
+    assert z.init_writers == {}
+
+    rt = Filler(handler_registry=db.reg.handler_reg)
+    events = 0
+    for nd in db[-1].documents():
+        n2, d2 = rt(*nd)
+        if n2 == "event":
+            events += 1
+            assert d2["data"]["img"].shape == (10, 10)
+    assert events == 5
+
+
+@pytest.mark.parametrize(
+    "writer, spec", [(NpyWriter, "npy"), (StackedNpyWriter, "npy_stack")]
+)
+def test_async_storage(RE, hw, db, tmpdir, writer, spec):
+    db.reg.register_handler("npy_stack", NpyStackHandler)
+    source = Stream()
+    z = source.Store(str(tmpdir), writer, max_workers=2, max_pending=2)
+    z.starsink(db.insert)
+    L = z.sink_to_list()
+
+    RE.subscribe(lambda *x: source.emit(x))
+    RE(bp.count([hw.direct_img], 5))
+
+    assert [n for n, d in L][-1] == "stop"
+    assert z.pending == {}
+    rt = Filler(handler_registry=db.reg.handler_reg)
+    events = 0
+    for nd in db[-1].documents():
+        n2, d2 = rt(*nd)
+        if n2 == "resource":
+            assert d2["spec"] == spec
+        if n2 == "event":
+            events += 1
+            assert d2["data"]["img"].shape == (10, 10)
+    assert events == 5
+
+
+@pytest.mark.parametrize("writer", [NpyWriter, StackedNpyWriter])
+def test_async_storage_reused_buffer(tmpdir, writer):
+    source = Stream()
+    z = source.Store(str(tmpdir), writer, max_workers=1)
+    L = z.sink_to_list()
+
+    run = compose_run()
+    source.emit(("start", run.start_doc))
+    desc = run.compose_descriptor(
+        name="primary",
+        data_keys={"img": {"source": "", "dtype": "array", "shape": [3]}},
+    )
+    source.emit(("descriptor", desc.descriptor_doc))
+    buf = np.zeros(3)
+    for i in range(5):
+        buf[:] = i
+        source.emit(
+            (
+                "event",
+                desc.compose_event(
+                    data={"img": buf}, timestamps={"img": 0}, filled={}
+                ),
+            )
+        )
+        # the upstream reuses its buffer straight away
+        buf[:] = -1
+    source.emit(("stop", run.compose_stop()))
+
+    assert [img[0] for img in _filled_imgs(L)] == [0, 1, 2, 3, 4]
+    z.close()
+    assert z.executor is None
+
+
+@pytest.mark.parametrize("writer", [NpyWriter, StackedNpyWriter])
+def test_mmap_handlers(RE, hw, tmpdir, writer):
+    source = Stream()
+    z = source.Store(str(tmpdir), writer)
+    L = z.sink_to_list()
+
+    RE.subscribe(lambda *x: source.emit(x))
+    RE(bp.count([hw.direct_img], 3))
+
+    mmap_cache.clear()
+    rt = Filler(handler_registry=handler_registry)
+    imgs = []
+    for nd in L:
+        n2, d2 = rt(*nd)
+        if n2 == "event":
+            imgs.append(d2["data"]["img"])
+            assert d2["data"]["img"].shape == (10, 10)
+            # the data is read from a memory map rather than loaded
+            assert isinstance(d2["data"]["img"], np.memmap)
+    assert len(imgs) == 3
+    # the stacked files are only opened once
+    assert len(mmap_cache.maps) == (3 if writer is NpyWriter else 1)
+
+
+def test_mmap_cache_lru(tmpdir):
+    fpaths = [str(tmpdir.join(f"{i}.npy")) for i in range(3)]
+    for i, fpath in enumerate(fpaths):
+        np.save(fpath, np.ones(5) * i)
+    mmap_cache.clear()
+    maxsize = mmap_cache.maxsize
+    mmap_cache.maxsize = 2
+    try:
+        a = mmap_cache.get(fpaths[0])
+        assert mmap_cache.get(fpaths[0]) is a
+        mmap_cache.get(fpaths[1])
+        mmap_cache.get(fpaths[0])
+        mmap_cache.get(fpaths[2])
+        # the least recently used file is dropped
+        assert list(mmap_cache.maps) == [fpaths[0], fpaths[2]]
+        assert mmap_cache.get(fpaths[2])[1] == 2
+    finally:
+        mmap_cache.maxsize = maxsize
+        mmap_cache.clear()
+
+
+def _run_with_repeats(source):
+    run = compose_run()
+    source.emit(("start", run.start_doc))
+    desc = run.compose_descriptor(
+        name="primary",
+        data_keys={
+            k: {"source": "", "dtype": "array", "shape": [3]}
+            for k in ["img", "mask"]
+        },
+    )
+    source.emit(("descriptor", desc.descriptor_doc))
+    for i in range(6):
+        source.emit(
+            (
+                "event",
+                desc.compose_event(
+                    data={"img": np.ones(3) * (i % 3), "mask": np.ones(3)},
+                    timestamps={"img": 0, "mask": 0},
+                    filled={},
+                ),
+            )
+        )
+    source.emit(("stop", run.compose_stop()))
+
+
+def _filled_imgs(docs):
+    rt = Filler(handler_registry=handler_registry)
+    imgs = []
+    for nd in docs:
+        n2, d2 = rt(*nd)
+        if n2 == "event":
+            imgs.append(d2["data"]["img"].copy())
+    return imgs
+
+
+def test_content_hash():
+    a = np.arange(6)
+    assert content_hash(a) == content_hash(a.copy())
+    assert content_hash(a) != content_hash(a.reshape(2, 3))
+    assert content_hash(a) != content_hash(a.astype(float))
+    # non contiguous arrays hash their contents
+    assert content_hash(a[::2]) == content_hash(np.array([0, 2, 4]))
+
+
+@pytest.mark.parametrize("writer", [NpyWriter, StackedNpyWriter])
+def test_dedup_storage(tmpdir, writer):
+    index = {}
+    source = Stream()
+    z = source.Store(str(tmpdir), writer, writer_kwargs={"dedup_index": index})
+    L = z.sink_to_list()
+
+    _run_with_repeats(source)
+    names = [n for n, d in L]
+    # only the 4 different arrays are written
+    assert names.count("datum") == 4
+    assert len(index) == 4
+    n_files = len(os.listdir(str(tmpdir.join("an_data"))))
+
+    imgs = _filled_imgs(L)
+    assert [img[0] for img in imgs] == [0, 1, 2, 0, 1, 2]
+
+    # the next run points to the files of the first
+    L.clear()
+    _run_with_repeats(source)
+    assert [n for n, d in L].count("datum") == 4
+    assert len(os.listdir(str(tmpdir.join("an_data")))) == n_files
+    imgs = _filled_imgs(L)
+    assert [img[0] for img in imgs] == [0, 1, 2, 0, 1, 2]
+
+
+def test_external_policy():
+    policy = ExternalPolicy(
+        min_bytes=100, keys={"mask": False}, dtypes={bool: False, "u1": True}
+    )
+    assert policy("img", np.ones(100))
+    assert not policy("img", np.ones(3))
+    assert not policy("mask", np.ones(100))
+    assert not policy("img", np.ones(1000, dtype=bool))
+    assert policy("img", np.ones(3, dtype="u1"))
+    # by default everything is written
+    assert ExternalPolicy()("img", np.ones(1))
+
+
+@pytest.mark.parametrize("writer", [NpyWriter, StackedNpyWriter])
+def test_inline_storage(tmpdir, writer):
+    source = Stream()
+    z = source.Store(
+        str(tmpdir),
+        writer,
+        writer_kwargs={"external": ExternalPolicy(keys={"mask": False})},
+    )
+    L = z.sink_to_list()
+
+    _run_with_repeats(source)
+    names = [n for n, d in L]
+    # only the images are written
+    assert names.count("datum") == 6
+    desc = [d for n, d in L if n == "descriptor"][0]
+    assert desc["data_keys"]["img"]["external"] == "FILESTORE:"
+    assert "external" not in desc["data_keys"]["mask"]
+    for n, d in L:
+        if n == "event":
+            assert d["data"]["mask"] == [1.0, 1.0, 1.0]
+            assert d["filled"] == {"img": False}
+
+
+@pytest.mark.parametrize("writer", [NpyWriter, StackedNpyWriter])
+def test_datum_pages(tmpdir, writer):
+    source = Stream()
+    z = source.Store(str(tmpdir), writer, datum_page_size=4)
+    L = z.sink_to_list()
+
+    _run_with_repeats(source)
+    names = [n for n, d in L]
+    assert "datum" not in names
+    pages = [d for n, d in L if n == "datum_page"]
+    # 12 datums, one page per resource per flush
+    assert sum(len(p["datum_id"]) for p in pages) == 12
+    if writer is StackedNpyWriter:
+        # a resource per key, flushed every 4 datums (2 events)
+        assert len(pages) == 6
+    else:
+        # a resource per array, so a page per datum
+        assert len(pages) == 12
+    assert names[-1] == "stop"
+    assert z.datum_buffer == [] and z.event_buffer == []
+
+    # the datums come before the events which use them
+    imgs = [img[0] for img in _filled_imgs(L)]
+    assert imgs == [0, 1, 2, 0, 1, 2]
+
+
+@pytest.mark.parametrize("writer", [NpyWriter, StackedNpyWriter])
+def test_event_page_storage(tmpdir, writer):
+    source = Stream()
+    t = FromEventStream("event", ("data", "det_image"), source, principle=True)
+    n = ToEventStream(t.map(np.ones), ("img",), event_page_size=2)
+    z = n.Store(str(tmpdir), writer)
+    L = z.sink_to_list()
+
+    for nd in y(5):
+        source.emit(nd)
+
+    names = [nd[0] for nd in L]
+    # the pages are written row by row
+    assert names.count("descriptor") == 1
+    assert names.count("datum") == 5
+    assert names.count("event") == 5
+    assert names[-1] == "stop"
+    desc = [d for n, d in L if n == "descriptor"][0]
+    assert desc["data_keys"]["img"]["external"] == "FILESTORE:"
+    assert [len(img) for img in _filled_imgs(L)] == [1, 2, 3, 4, 5]
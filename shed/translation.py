@@ -1,8 +1,13 @@
 import inspect
 import json
+import os
 import subprocess
+import sys
+import threading
 import time
+from functools import lru_cache
 from hashlib import sha256
+from weakref import WeakKeyDictionary
 
 import networkx as nx
 import numpy as np
@@ -10,7 +15,12 @@ from event_model import sanitize_doc
 from rapidz.core import Stream
 from rapidz.core import _deref_weakref, args_kwargs
 
-from .simple import SimpleToEventStream, SimpleFromEventStream, _hash_or_uid
+from .simple import (
+    SimpleToEventStream,
+    SimpleFromEventStream,
+    _hash_or_uid,
+    sizeof,
+)
 
 ALL = "--ALL THE DOCS--"
 
@@ -26,15 +36,188 @@ def conda_env():
         A dictionary representing the packages installed
 
     """
-    data = subprocess.check_output(["conda", "list", "--json"])
     try:
+        data = subprocess.check_output(["conda", "list", "--json"])
         j_data = json.loads(data)
-    except TypeError:  # pragma: noqa
+    except (OSError, subprocess.CalledProcessError, TypeError):
         j_data = "Failed to get packages"
     return {"packages": j_data}
 
 
-env_data = conda_env()
+_env_data = None
+_env_lock = threading.Lock()
+
+
+def _env_cache_path():
+    # Key the cache on the environment and when its packages last changed
+    prefix = os.environ.get("CONDA_PREFIX", sys.prefix)
+    try:
+        mtime = os.stat(os.path.join(prefix, "conda-meta")).st_mtime
+    except OSError:
+        mtime = None
+    key = sha256(f"{prefix}{mtime}".encode("utf-8")).hexdigest()
+    cache_dir = os.environ.get("SHED_CACHE_DIR")
+    if cache_dir is None:
+        xdg_cache = os.environ.get(
+            "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+        )
+        cache_dir = os.path.join(xdg_cache, "shed")
+    return os.path.join(cache_dir, f"conda_env_{key}.json")
+
+
+def get_env_data(refresh=False):
+    """Get information about the conda environment this is being run in
+
+    The information is captured on first use and cached, both in memory and
+    on disk, keyed by the environment prefix and the last time its packages
+    changed.
+
+    Parameters
+    ----------
+    refresh : bool, optional
+        If True recapture the information, even if it is cached. Defaults to
+        False
+
+    Returns
+    -------
+    dict :
+        A dictionary representing the packages installed
+    """
+    global _env_data
+    path = _env_cache_path()
+    with _env_lock:
+        if not refresh and _env_data is not None and _env_data[0] == path:
+            return _env_data[1]
+    # capture outside of the lock so a refresh doesn't block the start
+    # documents which use the cached data
+    data = _load_env_data(path, refresh)
+    with _env_lock:
+        _env_data = (path, data)
+    return data
+
+
+def _load_env_data(path, refresh):
+    if not refresh:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    data = conda_env()
+    # Don't cache failures
+    if isinstance(data["packages"], str):
+        return data
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError:  # pragma: no coverage
+        pass
+    return data
+
+
+def refresh_env_data():
+    """Recapture the conda environment information in a background thread
+
+    Returns
+    -------
+    Thread :
+        The (daemon) thread doing the capture
+    """
+    thread = threading.Thread(
+        target=get_env_data, kwargs={"refresh": True}, daemon=True
+    )
+    thread.start()
+    return thread
+
+
+class TimeLog(object):
+    """Compact log of when documents came through a node
+
+    The times are kept in a growable float64 array and the uids in a table
+    indexed by an integer array, with runs of the same uid (as logged by
+    ``ToEventStream``) stored once. Iterating over the log gives
+    ``(time, uid)`` tuples.
+
+    Parameters
+    ----------
+    size : int, optional
+        The initial number of entries to allocate, defaults to 1024
+    """
+
+    def __init__(self, size=1024):
+        self._size = size
+        self.clear()
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        uids = self._uids
+        return zip(
+            self._times[: self._len].tolist(),
+            (uids[i] for i in self._uid_idx[: self._len].tolist()),
+        )
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the time and uid index arrays"""
+        return self._times.nbytes + self._uid_idx.nbytes
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + self.nbytes + sizeof(self._uids)
+
+    def append(self, entry):
+        """Add a ``(time, uid)`` entry to the log"""
+        t, uid = entry
+        if self._len == len(self._times):
+            self._grow()
+        # intern runs of the same uid
+        if not self._uids or self._uids[-1] != uid:
+            self._uids.append(uid)
+        self._times[self._len] = t
+        self._uid_idx[self._len] = len(self._uids) - 1
+        self._len += 1
+
+    def extend(self, entries):
+        """Add ``(time, uid)`` entries to the log"""
+        for entry in entries:
+            self.append(entry)
+
+    def clear(self):
+        """Remove all the entries and release the memory"""
+        self._times = np.empty(self._size, dtype=np.float64)
+        self._uid_idx = np.empty(self._size, dtype=np.intp)
+        self._uids = []
+        self._len = 0
+
+    def _grow(self):
+        size = 2 * len(self._times)
+        times = np.empty(size, dtype=np.float64)
+        times[: self._len] = self._times[: self._len]
+        uid_idx = np.empty(size, dtype=np.intp)
+        uid_idx[: self._len] = self._uid_idx[: self._len]
+        self._times = times
+        self._uid_idx = uid_idx
+
+    def export(self, node_uid):
+        """Export the log in the format of the stop document ``times``
+
+        Parameters
+        ----------
+        node_uid : str
+            The uid of the node the log belongs to
+
+        Returns
+        -------
+        list of dict :
+            ``{"time": time, "node": node_uid, "uid": uid}`` for each entry
+        """
+        return [
+            {"time": t, "node": node_uid, "uid": uid} for t, uid in self
+        ]
 
 
 @args_kwargs
@@ -63,14 +246,38 @@ class FromEventStream(SimpleFromEventStream):
         downstream ToEventStream nodes will issue a stop document.
         Defaults to False. Note that one principle node is required for
         proper pipeline operation.
+    zero_copy : bool, optional
+        If True the incoming documents are not copied, the data address is
+        looked up on a read-only view of the document and only mappings which
+        are emitted are (shallowly) copied. Defaults to False.
+    columnar : bool, optional
+        If True ``event_page`` documents are emitted as a whole, with each
+        addressed column converted to an array. Otherwise each row of the page
+        is emitted as if it were an ``event``. Defaults to False.
+    batch : int, optional
+        If provided the data from this many consecutive events is stacked
+        into one array and emitted along with the list of the event uids,
+        as ``(array, uids)``. Defaults to None.
+    max_latency : float, optional
+        If provided the batch is emitted once its oldest data is this many
+        seconds old, even if the batch is not full. Defaults to None.
 
     Notes
     -----
     The result emitted from this stream no longer follows the document
     model.
 
+    Nodes extracting from ``event`` documents also extract from
+    ``event_page`` documents.
+
+    When batching, partial batches are emitted when the stop (or the next
+    start) document comes in, or by calling ``flush``. The ``max_latency``
+    is checked as events come in and, if the node has an event loop, on a
+    timer. Batches are always split by row so ``columnar`` is ignored.
+
     This node also keeps track of when and which data came through the
-    node.
+    node, the rows of ``event_page`` documents are tracked as individual
+    events.
 
 
     Examples
@@ -106,6 +313,10 @@ class FromEventStream(SimpleFromEventStream):
         event_stream_name=ALL,
         stream_name=None,
         principle=False,
+        zero_copy=False,
+        columnar=False,
+        batch=None,
+        max_latency=None,
         **kwargs,
     ):
         super().__init__(
@@ -115,19 +326,35 @@ class FromEventStream(SimpleFromEventStream):
             stream_name=stream_name,
             principle=principle,
             event_stream_name=event_stream_name,
+            zero_copy=zero_copy,
+            columnar=columnar,
+            batch=batch,
+            max_latency=max_latency,
             **kwargs,
         )
         self.run_start_uid = None
-        self.times = []
+        self.times = TimeLog()
 
     def update(self, x, who=None):
         name, doc = x
-        self.times.append((time.time(), doc.get("uid", doc.get("datum_id"))))
+        if name == "event_page":
+            t = time.time()
+            self.times.extend((t, uid) for uid in doc["uid"])
+        else:
+            self.times.append(
+                (time.time(), doc.get("uid", doc.get("datum_id")))
+            )
         if name == "start":
-            self.times = [(time.time(), doc["uid"])]
+            self.times.clear()
+            self.times.append((time.time(), doc["uid"]))
             self.start_uid = doc["uid"]
         return super().update(x, who=None)
 
+    def memory_usage(self):
+        usage = super().memory_usage()
+        usage["times"] = sys.getsizeof(self.times)
+        return usage
+
 
 @args_kwargs
 @Stream.register_api()
@@ -143,6 +370,12 @@ class ToEventStream(SimpleToEventStream):
         the keys from the dict. Defauls to None
     stream_name : str, optional
         Name for this stream node
+    event_page_size : int, optional
+        If provided events are emitted as ``event_page`` documents holding
+        this many events. Defaults to None
+    event_page_interval : float, optional
+        If provided events are emitted as ``event_page`` documents once the
+        oldest event in the page is this many seconds old. Defaults to None
 
     Notes
     -----
@@ -153,6 +386,9 @@ class ToEventStream(SimpleToEventStream):
     Note that start -> start is not allowed, this node always issues a stop
     document so the data input times can be stored.
 
+    When emitting event pages, any partial page is emitted before the
+    stop document.
+
     Examples
     --------
     >>> import uuid
@@ -197,7 +433,7 @@ class ToEventStream(SimpleToEventStream):
         if env_capture_functions is None:
             env_capture_functions = []
         self.env_capture_functions = env_capture_functions
-        self.times = []
+        self.times = TimeLog()
         for node, attrs in self.graph.nodes.items():
             for arg in getattr(attrs["stream"], "_init_args", []):
                 if getattr(arg, "__name__", "") == "<lambda>":
@@ -210,14 +446,16 @@ class ToEventStream(SimpleToEventStream):
     def emit(self, x, asynchronous=False):
         name, doc = x
         if name == "start":
-            self.times = [(time.time(), self.start_uid)]
+            self.times.clear()
+            self.times.append((time.time(), self.start_uid))
         self.times.append((time.time(), self.start_uid))
         super().emit(x, asynchronous=asynchronous)
 
     def start_doc(self, x):
         new_start_doc = super().start_doc(x)
         new_start_doc.update(graph=self.graph)
-        new_start_doc["env"] = env_data
+        # copy so the capture functions don't change the cached data
+        new_start_doc["env"] = dict(get_env_data())
         if self.env_capture_functions:
             for f in self.env_capture_functions:
                 new_start_doc["env"].update(f())
@@ -227,52 +465,233 @@ class ToEventStream(SimpleToEventStream):
         new_stop = super().stop(x)
         times = []
         for k, node in self.translation_nodes.items():
-            for t, uid in node.times:
-                times.append({"time": t, "node": node.uid, "uid": uid})
+            times.extend(node.times.export(node.uid))
         new_stop.update(times=times)
         return new_stop
 
+    def memory_usage(self):
+        usage = super().memory_usage()
+        usage["times"] = sys.getsizeof(self.times)
+        return usage
 
-def merkle_hash(node):
-    hasher = sha256()
+
+# node -> (stamp, local hash string), the stamp holds the node's runtime
+# args/kwargs so changing them invalidates the entry
+_merkle_cache = WeakKeyDictionary()
+
+
+def _merkle_stamp(node):
+    args = getattr(node, "args", None)
+    kwargs = getattr(node, "kwargs", None)
+    objs = tuple(args or ()) + tuple(kwargs.values() if kwargs else ())
+    shape = (
+        None if args is None else len(args),
+        None if kwargs is None else tuple(kwargs),
+    )
+    return shape, objs
+
+
+def _same_stamp(stamp, other):
+    # compare the args by identity, they may be arrays or other things which
+    # don't have a sane ``==``
+    return stamp[0] == other[0] and all(
+        a is b for a, b in zip(stamp[1], other[1])
+    )
+
+
+def _local_merkle_string(node):
+    stamp = _merkle_stamp(node)
+    cached = _merkle_cache.get(node)
+    if cached is not None and _same_stamp(cached[0], stamp):
+        return cached[1]
     dbf_node = sanitize_doc(merkle_friendly_node(node))
     hash_string = ",".join(
         str(dbf_node[k]) for k in ["name", "mod", "args", "kwargs"]
     )
-    hasher.update(hash_string.encode("utf-8"))
-    # Once we hit from event stream we don't need to go higher in the graph
-    if isinstance(node, SimpleFromEventStream):
-        return hasher.hexdigest()
-    for u in node.upstreams:
-        idx = u.downstreams.index(node)
-        u_m_hash = merkle_hash(u)
-        hasher.update(f"{idx}{u_m_hash}".encode("utf-8"))
-    return hasher.hexdigest()
+    _merkle_cache[node] = (stamp, hash_string)
+    return hash_string
+
+
+def _merkle_hashes(node, hashes=None):
+    """Hash ``node`` and its ancestors (up to the ``FromEventStream`` nodes)
+
+    Parameters
+    ----------
+    node : Stream
+        The node to hash
+    hashes : dict, optional
+        Already computed hashes (keyed by node), updated in place
+
+    Returns
+    -------
+    hashes : dict
+        The hashes of ``node`` and all its ancestors
+    """
+    if hashes is None:
+        hashes = {}
+    # iterative post order walk so deep graphs don't hit the recursion limit
+    # and shared ancestors are only hashed once
+    visiting = set()
+    stack = [node]
+    while stack:
+        n = stack[-1]
+        if n in hashes:
+            stack.pop()
+            continue
+        if isinstance(n, SimpleFromEventStream):
+            ups = []
+        else:
+            ups = [u for u in n.upstreams if u not in hashes]
+        if ups and n not in visiting:
+            visiting.add(n)
+            for u in reversed(ups):
+                if u in visiting:
+                    raise RuntimeError(
+                        "Can not hash a graph with cycles, "
+                        f"{u} is its own ancestor"
+                    )
+                stack.append(u)
+            continue
+        stack.pop()
+        visiting.discard(n)
+        hasher = sha256()
+        hasher.update(_local_merkle_string(n).encode("utf-8"))
+        # Once we hit from event stream we don't need to go higher in the
+        # graph
+        if not isinstance(n, SimpleFromEventStream):
+            for u in n.upstreams:
+                idx = u.downstreams.index(n)
+                hasher.update(f"{idx}{hashes[u]}".encode("utf-8"))
+        hashes[n] = hasher.hexdigest()
+    return hashes
+
+
+def merkle_hash(node):
+    """Hash a node and its ancestors
+
+    The hash depends on the class, args and kwargs of every node between
+    ``node`` and the ``FromEventStream`` nodes (and how they are connected)
+    so identical pipelines hash the same.
+
+    Parameters
+    ----------
+    node : Stream
+        The node to hash
+
+    Returns
+    -------
+    str :
+        The hex digest of the hash
+    """
+    return _merkle_hashes(node)[node]
 
 
 # TODO: move this to a callback?
 @Stream.register_api()
 class DBFriendly(Stream):
-    """Make analyzed data (and graph) DB friendly"""
+    """Make analyzed data (and graph) DB friendly
+
+    The serialized graph is cached and only rebuilt when the graph or the
+    args/kwargs of one of its nodes change. Each start document gets its own
+    copy of the top level of the graph and of its list of nodes (so nodes can
+    be added, removed or annotated), the serialized nodes and links inside
+    them are shared between the start documents and must not be changed."""
+
+    def __init__(self, upstream, stream_name=None, **kwargs):
+        Stream.__init__(self, upstream, stream_name=stream_name, **kwargs)
+        # node uid -> (node, stamp, db friendly node)
+        self._node_cache = {}
+        # (graph, (number of nodes, number of edges), outbound node,
+        #  stamps, graph hash, serialized graph)
+        self._graph_cache = None
+
+    def _graph_stamps(self, graph):
+        return tuple(
+            (n, attrs["stream"], _merkle_stamp(attrs["stream"]))
+            for n, attrs in graph.nodes.items()
+        )
+
+    def _serialize(self, graph, outbound_node):
+        stamps = self._graph_stamps(graph)
+        size = (graph.number_of_nodes(), graph.number_of_edges())
+        cache = self._graph_cache
+        if (
+            cache is not None
+            and cache[0] is graph
+            and cache[1] == size
+            and cache[2] == outbound_node
+            and len(cache[3]) == len(stamps)
+            and all(
+                n == nn and s is ss and _same_stamp(st, sst)
+                for (n, s, st), (nn, ss, sst) in zip(cache[3], stamps)
+            )
+        ):
+            return cache[4], cache[5]
+        graph_hash = merkle_hash(graph.nodes[outbound_node]["stream"])
+        # copy this so we don't change the pipeline's graph
+        pipeline_graph, graph = graph, graph.copy()
+        node_cache = {}
+        # TODO: this might not be possible if there are cycles!!!!
+        for n in nx.topological_sort(graph):
+            stream = graph.nodes[n]["stream"]
+            stamp = _merkle_stamp(stream)
+            cached = self._node_cache.get(n)
+            if (
+                cached is None
+                or cached[0] is not stream
+                or not _same_stamp(cached[1], stamp)
+            ):
+                cached = (stream, stamp, db_friendly_node(stream))
+            node_cache[n] = cached
+            graph.nodes[n]["stream"] = cached[2]
+        self._node_cache = node_cache
+        data = nx.node_link_data(graph)
+        self._graph_cache = (
+            pipeline_graph,
+            size,
+            outbound_node,
+            stamps,
+            graph_hash,
+            data,
+        )
+        return graph_hash, data
+
+    def memory_usage(self):
+        """The estimated memory (in bytes) used by the state of this node
+
+        Returns
+        -------
+        dict :
+            The size of each piece of state
+        """
+        return {
+            "node_cache": sizeof(self._node_cache),
+            "graph_cache": sizeof(self._graph_cache),
+        }
 
     def update(self, x, who=None):
         name, doc = x
         if name == "start":
             doc = dict(doc)
-            # copy this so we do this each time and get updates
-            graph = doc["graph"].copy()
-            doc["graph_hash"] = merkle_hash(
-                graph.nodes[doc["outbound_node"]]["stream"]
+            doc["graph_hash"], graph = self._serialize(
+                doc["graph"], doc["outbound_node"]
             )
-            # TODO: this might not be possible if there are cycles!!!!
-            for n in nx.topological_sort(graph):
-                graph.nodes[n]["stream"] = db_friendly_node(
-                    graph.nodes[n]["stream"]
-                )
-            doc["graph"] = nx.node_link_data(graph)
+            doc["graph"] = _copy_graph(graph)
         return self.emit((name, doc))
 
 
+def _copy_graph(graph):
+    # copy the containers sinks are likely to change, without walking into
+    # the serialized nodes, so the cost doesn't depend on what the nodes hold
+    graph = dict(graph)
+    for k, v in graph.items():
+        if isinstance(v, dict):
+            graph[k] = dict(v)
+        elif isinstance(v, list):
+            graph[k] = [dict(i) if isinstance(i, dict) else i for i in v]
+    return graph
+
+
 def _is_stream(x):
     return isinstance(x, Stream)
 
@@ -288,6 +707,12 @@ def _deref_func(x):
 deref_dict = {_is_stream: _hash_or_uid, callable: _deref_func}
 
 
+@lru_cache(maxsize=None)
+def _init_parameters(cls):
+    """The names of the ``__init__`` parameters of ``cls`` (without self)"""
+    return tuple(inspect.signature(cls.__init__).parameters)[1:]
+
+
 def db_friendly_node(node):
     """Extract data to make node db friendly"""
     if isinstance(node, dict):
@@ -305,9 +730,9 @@ def db_friendly_node(node):
     # inspect the init for the number of args which are not
     # *args, remove the args which are more than that and replace with
     # node.args in case they have changed
-    sig = inspect.signature(node.__init__)
-    if "args" in sig.parameters and hasattr(node, "args"):
-        idx = list(sig.parameters).index("args")
+    params = _init_parameters(type(node))
+    if "args" in params and hasattr(node, "args"):
+        idx = params.index("args")
         args[idx:] = node.args
 
     kwargs = node._init_kwargs
@@ -372,9 +797,9 @@ def merkle_friendly_node(node):
     # inspect the init for the number of args which are not
     # *args, remove the args which are more than that and replace with
     # node.args in case they have changed
-    sig = inspect.signature(node.__init__)
-    if "args" in sig.parameters and hasattr(node, "args"):
-        idx = list(sig.parameters).index("args")
+    params = _init_parameters(type(node))
+    if "args" in params and hasattr(node, "args"):
+        idx = params.index("args")
         args[idx:] = node.args
 
     kwargs = node._init_kwargs
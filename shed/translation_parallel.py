@@ -1,3 +1,4 @@
+import sys
 import time
 
 import numpy as np
@@ -5,7 +6,7 @@ from rapidz.core import args_kwargs
 from rapidz.parallel import ParallelStream
 
 from .simple_parallel import SimpleToEventStream
-from .translation import env_data
+from .translation import get_env_data, TimeLog
 
 ALL = "--ALL THE DOCS--"
 
@@ -80,7 +81,7 @@ class ToEventStream(SimpleToEventStream):
         if env_capture_functions is None:
             env_capture_functions = []
         self.env_capture_functions = env_capture_functions
-        self.times = []
+        self.times = TimeLog()
         for node, attrs in self.graph.nodes.items():
             for arg in getattr(attrs["stream"], "_init_args", []):
                 if getattr(arg, "__name__", "") == "<lambda>":
@@ -93,14 +94,16 @@ class ToEventStream(SimpleToEventStream):
     def emit(self, x, asynchronous=False):
         name, doc = x
         if name == "start":
-            self.times = [(time.time(), self.start_uid)]
+            self.times.clear()
+            self.times.append((time.time(), self.start_uid))
         self.times.append((time.time(), self.start_uid))
         super().emit(x, asynchronous=asynchronous)
 
     def start_doc(self, x):
         new_start_doc = super().start_doc(x)
         new_start_doc.update(graph=self.graph)
-        new_start_doc["env"] = env_data
+        # copy so the capture functions don't change the cached data
+        new_start_doc["env"] = dict(get_env_data())
         if self.env_capture_functions:
             for f in self.env_capture_functions:
                 new_start_doc["env"].update(f())
@@ -110,7 +113,11 @@ class ToEventStream(SimpleToEventStream):
         new_stop = super().stop(x)
         times = []
         for k, node in self.translation_nodes.items():
-            for t, uid in node.times:
-                times.append({"time": t, "node": node.uid, "uid": uid})
+            times.extend(node.times.export(node.uid))
         new_stop.update(times=times)
         return new_stop
+
+    def memory_usage(self):
+        usage = super().memory_usage()
+        usage["times"] = sys.getsizeof(self.times)
+        return usage
@@ -1,21 +1,145 @@
+import hashlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import BoundedSemaphore, Lock
+
 from rapidz import Stream
 import os
+import struct
 import numpy as np
-from event_model import compose_resource
+from event_model import (
+    compose_resource,
+    pack_datum_page,
+    unpack_event_page,
+)
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from shed.simple import sizeof
+
+
+class _PendingWrites:
+    """The writes of a run running in the background"""
+
+    def __init__(self, executor, slots):
+        self.executor = executor
+        self.slots = slots
+        self.lock = Lock()
+        self.futures = set()
+        self.errors = []
+
+    def submit(self, func, *args):
+        # snapshot the arrays, the upstream may reuse its buffers once the
+        # event has gone through
+        args = [np.array(a) if isinstance(a, np.ndarray) else a for a in args]
+        # block if there are too many writes in flight
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(func, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self.slots.release()
+        with self.lock:
+            self.futures.discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                self.errors.append(future.exception())
+
+    def wait(self):
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+        if self.errors:
+            raise self.errors[0]
 
 
 @Stream.register_api()
 class Store(Stream):
-    def __init__(self, upstream, root, writer, resource_kwargs=None, **kwargs):
+    """Write the arrays in events to disk, emitting the resource and datum
+    documents which point to them
+
+    Parameters
+    ----------
+    upstream : Stream
+        The stream of documents
+    root : str
+        The directory to write to
+    writer : type
+        The writer to use, built with ``root``, the start document and
+        ``resource_kwargs`` for each run
+    resource_kwargs : dict, optional
+        The resource kwargs passed to the writer
+    writer_kwargs : dict, optional
+        Extra kwargs for the writer (eg. ``dedup``)
+    max_workers : int, optional
+        If given write in a pool of this many threads rather than on the
+        pipeline's thread. The documents are still emitted in order, the
+        stop document is emitted once all the writes of the run are done.
+        The arrays are copied before they are handed to the pool. Call
+        ``close`` to shut the pool down.
+    max_pending : int, optional
+        The number of writes which can be waiting in the pool before the
+        pipeline is blocked, defaults to four times ``max_workers``
+    datum_page_size : int, optional
+        If given emit the datums in ``datum_page`` documents of up to this
+        many datums (one page per resource). The events are held back until
+        the page with their datums is emitted. The pages are also flushed at
+        the stop. As ``NpyWriter`` makes a resource for every array this
+        only cuts down the number of documents with writers which share
+        resources between datums (eg. ``StackedNpyWriter``).
+
+    Notes
+    -----
+    ``event_page`` documents are unpacked and written row by row, the events
+    (which now hold datum ids) are emitted individually.
+    """
+
+    def __init__(
+        self,
+        upstream,
+        root,
+        writer,
+        resource_kwargs=None,
+        writer_kwargs=None,
+        max_workers=None,
+        max_pending=None,
+        datum_page_size=None,
+        **kwargs
+    ):
         Stream.__init__(self, upstream, **kwargs)
         if writer is None:
             writer = {}
         self.writer = writer
         self.root = root
         self.resource_kwargs = resource_kwargs
+        if writer_kwargs is None:
+            writer_kwargs = {}
+        self.writer_kwargs = writer_kwargs
         self.init_writers = {}
         self.descriptors = {}
         self.not_issued_descriptors = set()
+        self.executor = None
+        if max_workers:
+            self.executor = ThreadPoolExecutor(max_workers)
+            if max_pending is None:
+                max_pending = 4 * max_workers
+            self._slots = BoundedSemaphore(max_pending)
+        # run start uid -> writes in the background
+        self.pending = {}
+        self.datum_page_size = datum_page_size
+        # the datums waiting to go out in pages and the events waiting on
+        # them
+        self.datum_buffer = []
+        self.event_buffer = []
 
     def update(self, x, who=None):
         name, doc = x
@@ -24,14 +148,24 @@ class Store(Stream):
         doc = dict(doc)
 
         if name == "start":
-            self.init_writers[doc["uid"]] = self.writer(
-                self.root, doc, self.resource_kwargs
+            writer = self.writer(
+                self.root, doc, self.resource_kwargs, **self.writer_kwargs
             )
+            if self.executor is not None:
+                pending = _PendingWrites(self.executor, self._slots)
+                self.pending[doc["uid"]] = pending
+                writer.submit = pending.submit
+            self.init_writers[doc["uid"]] = writer
         if name == "descriptor":
             self.descriptors[doc["uid"]] = doc
             self.not_issued_descriptors.add(doc["uid"])
             return
 
+        elif name == "event_page":
+            ret = []
+            for event in unpack_event_page(doc):
+                ret.extend(self.update(("event", event)))
+            return ret
         elif name == "event":
             ret = []
             writer = self.init_writers[
@@ -45,57 +179,528 @@ class Store(Stream):
                 ):
 
                     # For each of the filled keys let us know that it is backed
-                    # by FILESTORE
+                    # by FILESTORE, the others are in the event
                     descriptor = self.descriptors[doc["descriptor"]]
-                    for k, v in doc["filled"].items():
-                        if not v:
+                    for k in doc["data"]:
+                        if doc["filled"].get(k, True) is False:
                             descriptor["data_keys"][k].update(
                                 external="FILESTORE:"
                             )
+                        else:
+                            descriptor["data_keys"][k].pop("external", None)
                     ret.append(self.emit(("descriptor", descriptor)))
 
                     # We're done with that descriptor now
                     self.not_issued_descriptors.remove(doc["descriptor"])
+                if self.datum_page_size:
+                    if n == "datum":
+                        self.datum_buffer.append(d)
+                        continue
+                    # keep the events in order behind the buffered ones
+                    if n == "event" and (
+                        self.datum_buffer or self.event_buffer
+                    ):
+                        self.event_buffer.append((n, d))
+                        if len(self.datum_buffer) >= self.datum_page_size:
+                            ret.extend(self.flush_datums())
+                        continue
                 ret.append(self.emit((n, d)))
             return ret
         elif name == "stop":
             # clean up our cache (allow multi stops if needed)
-            self.init_writers.pop(doc["run_start"], None)
+            writer = self.init_writers.pop(doc["run_start"], None)
+            pending = self.pending.pop(doc["run_start"], None)
+            for uid in [
+                k
+                for k, d in self.descriptors.items()
+                if d.get("run_start") == doc["run_start"]
+            ]:
+                del self.descriptors[uid]
+                self.not_issued_descriptors.discard(uid)
+            ret = self.flush_datums()
+            # the stop only goes out once all the data is on disk
+            try:
+                if pending is not None:
+                    pending.wait()
+            finally:
+                if hasattr(writer, "close"):
+                    writer.close()
+            if ret:
+                ret.append(self.emit((name, doc)))
+                return ret
 
         return self.emit((name, doc))
 
+    def close(self):
+        """Shut down the thread pool, once the writes in flight are done
 
-class NpyWriter:
-    spec = "npy"
+        Later runs are written on the pipeline's thread.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def flush_datums(self):
+        """Emit the buffered datums (as datum pages) and the events waiting
+        on them"""
+        ret = []
+        pages = {}
+        for datum in self.datum_buffer:
+            pages.setdefault(datum["resource"], []).append(datum)
+        for datums in pages.values():
+            ret.append(self.emit(("datum_page", pack_datum_page(*datums))))
+        for nd in self.event_buffer:
+            ret.append(self.emit(nd))
+        self.datum_buffer = []
+        self.event_buffer = []
+        return ret
+
+    def memory_usage(self):
+        """The estimated memory (in bytes) used by the state of this node
+
+        Returns
+        -------
+        dict :
+            The size of each piece of state
+        """
+        return {
+            "init_writers": sizeof(self.init_writers),
+            "descriptors": sizeof(self.descriptors),
+            "not_issued_descriptors": sizeof(self.not_issued_descriptors),
+            "datum_buffer": sizeof(self.datum_buffer),
+            "event_buffer": sizeof(self.event_buffer),
+        }
+
+
+def _save_npy(fpath, v):
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    np.save(fpath, v)
+
+
+def content_hash(v):
+    """Hash the dtype, shape and contents of an array
+
+    Uses xxhash if it is installed, otherwise blake2b.
 
-    def __init__(self, root, start, resource_kwargs=None):
+    Parameters
+    ----------
+    v : np.ndarray
+        The array
+
+    Returns
+    -------
+    str :
+        The hex digest of the hash
+    """
+    if xxhash is not None:
+        h = getattr(xxhash, "xxh3_128", xxhash.xxh64)()
+    else:
+        h = hashlib.blake2b(digest_size=16)
+    h.update(f"{v.dtype.str}{v.shape}".encode("utf-8"))
+    h.update(np.ascontiguousarray(v).data)
+    return h.hexdigest()
+
+
+class ExternalPolicy:
+    """Decide which arrays are written to files and which stay in the event
+    (as lists)
+
+    Parameters
+    ----------
+    min_bytes : int, optional
+        Arrays smaller than this stay in the event, defaults to 0 (all the
+        arrays are written)
+    keys : dict, optional
+        Always (True) or never (False) write the arrays of these data keys
+    dtypes : dict, optional
+        Always (True) or never (False) write the arrays of these dtypes
+
+    Notes
+    -----
+    The data key rules come first, then the dtype rules and then the size.
+    """
+
+    def __init__(self, min_bytes=0, keys=None, dtypes=None):
+        self.min_bytes = min_bytes
+        self.keys = dict(keys or {})
+        self.dtypes = {np.dtype(k): v for k, v in (dtypes or {}).items()}
+
+    def __call__(self, key, value):
+        """Whether to write the array to a file
+
+        Parameters
+        ----------
+        key : str
+            The data key
+        value : np.ndarray
+            The array
+
+        Returns
+        -------
+        bool :
+            True if the array should be written to a file
+        """
+        if key in self.keys:
+            return self.keys[key]
+        if value.dtype in self.dtypes:
+            return self.dtypes[value.dtype]
+        return value.nbytes >= self.min_bytes
+
+
+class _ArrayWriter(ABC):
+    """Base for the writers which put the arrays in events into files
+
+    Parameters
+    ----------
+    root : str
+        The directory to write to
+    start : dict
+        The start document of the run
+    resource_kwargs : dict, optional
+        The resource kwargs
+    dedup : bool, optional
+        If True arrays with the same dtype, shape and contents are only
+        written once per run, later events point to the first datum.
+        Defaults to False
+    dedup_index : dict, optional
+        A map between the content hash and where the array was written,
+        share it between runs to also reuse the files written by earlier
+        runs (the run gets its own resource and datum pointing to the old
+        file). Implies ``dedup``.
+    external : callable, optional
+        Called with the data key and the array, returns True if the array
+        should be written to a file, otherwise it stays in the event as a
+        list. The first array of each data key in the run decides for the
+        whole run so the descriptor is correct. Defaults to writing all the
+        arrays (see ``ExternalPolicy``).
+    """
+
+    spec = None
+    # keep the resources of the run so more datums can point to them
+    keep_resources = False
+
+    def __init__(
+        self,
+        root,
+        start,
+        resource_kwargs=None,
+        dedup=False,
+        dedup_index=None,
+        external=None,
+    ):
         if resource_kwargs is None:
             resource_kwargs = {}
         self.resource_kwargs = resource_kwargs
         self.root = root
-        self.datum_kwargs = {}
         self.start = start
+        self.dedup = dedup or dedup_index is not None
+        self.dedup_index = dedup_index
+        # content hash -> datum id of the arrays written in this run
+        self.datum_ids = {}
+        # (root, resource path) -> compose_datum of the run's resources
+        self.resources = {}
+        if external is None:
+            external = ExternalPolicy()
+        self.external = external
+        # (descriptor uid, data key) -> if the key is written to files
+        self.external_keys = {}
+
+    def submit(self, func, *args):
+        """Run the I/O ``func(*args)``, ``Store`` replaces this to run it in
+        the background"""
+        func(*args)
+
+    def _resource(self, root, resource_path):
+        compose_datum = self.resources.get((root, resource_path))
+        if compose_datum is not None:
+            return None, compose_datum
+        resource, compose_datum, compose_datum_page = compose_resource(
+            start=self.start,
+            spec=self.spec,
+            root=root,
+            resource_path=resource_path,
+            resource_kwargs=self.resource_kwargs,
+        )
+        if self.dedup or self.keep_resources:
+            self.resources[(root, resource_path)] = compose_datum
+        return resource, compose_datum
+
+    @abstractmethod
+    def _write_array(self, event, k, v):
+        """Write an array
+
+        Returns
+        -------
+        root : str
+        resource_path : str
+        datum_kwargs : dict
+            Where the array was written
+        """
 
     def write(self, event):
         for k, v in event["data"].items():
             if isinstance(v, np.ndarray) and v.shape != ():
-                resource_path = f'an_data/{event["uid"]}_{k}.npy'
-                fpath = os.path.join(self.root, resource_path)
-                os.makedirs(os.path.dirname(fpath), exist_ok=True)
-                np.save(fpath, v)
-                resource, compose_datum, compose_datum_page = compose_resource(
-                    start=self.start,
-                    spec=self.spec,
-                    root=self.root,
-                    resource_path=resource_path,
-                    resource_kwargs=self.resource_kwargs,
-                )
-                yield "resource", resource
-                datum = compose_datum(datum_kwargs=self.datum_kwargs)
-                yield "datum", datum
-                event["data"][k] = datum["datum_id"]
+                external = self.external_keys.get((event["descriptor"], k))
+                if external is None:
+                    external = bool(self.external(k, v))
+                    self.external_keys[(event["descriptor"], k)] = external
+                if not external:
+                    event["data"][k] = v.tolist()
+                    continue
+                key = None
+                # object arrays only hold pointers
+                if self.dedup and not v.dtype.hasobject:
+                    key = content_hash(v)
+                datum_id = self.datum_ids.get(key)
+                if datum_id is None:
+                    location = None
+                    if key is not None and self.dedup_index is not None:
+                        location = self.dedup_index.get(key)
+                    if location is None:
+                        location = self._write_array(event, k, v)
+                    resource, compose_datum = self._resource(*location[:2])
+                    if resource is not None:
+                        yield "resource", resource
+                    datum = compose_datum(datum_kwargs=location[2])
+                    yield "datum", datum
+                    datum_id = datum["datum_id"]
+                    if key is not None:
+                        self.datum_ids[key] = datum_id
+                        if self.dedup_index is not None:
+                            self.dedup_index[key] = location
+                event["data"][k] = datum_id
                 event["filled"][k] = False
             # Don't write a file just for a single number!
             elif isinstance(v, np.ndarray) and np.isscalar(v):
                 event["data"][k] = v.item()
         yield "event", event
+
+
+class NpyWriter(_ArrayWriter):
+    """Write each array into its own npy file
+
+    Each file is its own resource, so the datums can't share a datum page.
+    """
+
+    spec = "npy"
+    datum_kwargs = {}
+
+    def _write_array(self, event, k, v):
+        resource_path = f'an_data/{event["uid"]}_{k}.npy'
+        fpath = os.path.join(self.root, resource_path)
+        self.submit(_save_npy, fpath, v)
+        return self.root, resource_path, dict(self.datum_kwargs)
+
+
+def _npy_header(dtype, shape, length=None):
+    """Make a npy (version 1.0) header, padded to ``length`` bytes"""
+    header = repr(
+        {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": False,
+            "shape": tuple(shape),
+        }
+    )
+    # magic string, version and header length
+    prefix = 10
+    if length is None:
+        # leave room for the longest first dimension and align to 64 bytes
+        longest = len(repr((2 ** 63,) + tuple(shape[1:]))) - len(
+            repr(tuple(shape))
+        )
+        length = -(-(prefix + len(header) + longest + 1) // 64) * 64
+    header = header.ljust(length - prefix - 1) + "\n"
+    return (
+        np.lib.format.magic(1, 0)
+        + struct.pack("<H", len(header))
+        + header.encode("latin1")
+    )
+
+
+class _NpyStack:
+    """A npy file which frames are written to"""
+
+    def __init__(self, fpath, dtype, frame_shape):
+        self.dtype = dtype
+        self.frame_shape = frame_shape
+        self.frame_size = dtype.itemsize * int(np.prod(frame_shape))
+        # frames handed out and frames in the header
+        self.n = 0
+        self.written = 0
+        self.lock = Lock()
+        self.file = open(fpath, "wb+")
+        self.header = _npy_header(dtype, (0,) + frame_shape)
+        self.file.write(self.header)
+        self.file.flush()
+
+    def reserve(self):
+        """The index for the next frame"""
+        self.n += 1
+        return self.n - 1
+
+    def write_frame(self, idx, frame):
+        """Write a frame at its index, frames may be written out of order"""
+        data = np.ascontiguousarray(frame, self.dtype).tobytes()
+        with self.lock:
+            self.file.seek(len(self.header) + idx * self.frame_size)
+            self.file.write(data)
+            # rewrite the header in place so the file is always readable
+            self.written = max(self.written, idx + 1)
+            self.file.seek(0)
+            self.file.write(
+                _npy_header(
+                    self.dtype,
+                    (self.written,) + self.frame_shape,
+                    len(self.header),
+                )
+            )
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class StackedNpyWriter(_ArrayWriter):
+    """Write the arrays of each data key into one npy file per run
+
+    Each frame is appended to the file, with one resource per data key (and
+    frame shape/dtype) per run and one datum per frame. Read the files back
+    with ``NpyStackHandler``.
+    """
+
+    spec = "npy_stack"
+    keep_resources = True
+
+    def __init__(self, root, start, resource_kwargs=None, **kwargs):
+        super().__init__(root, start, resource_kwargs, **kwargs)
+        # data key -> (stack, resource path)
+        self.stacks = {}
+        self.n_stacks = 0
+        self.closed_stacks = []
+
+    def _new_stack(self, k, v):
+        resource_path = f'an_data/{self.start["uid"]}_{k}_{self.n_stacks}.npy'
+        self.n_stacks += 1
+        fpath = os.path.join(self.root, resource_path)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        old = self.stacks.get(k)
+        if old is not None:
+            # there may still be writes to it in flight
+            self.closed_stacks.append(old[0])
+        self.stacks[k] = (_NpyStack(fpath, v.dtype, v.shape), resource_path)
+
+    def _write_array(self, event, k, v):
+        stack = self.stacks.get(k)
+        # Start a new file if the frames change shape or type
+        if (
+            stack is None
+            or stack[0].frame_shape != v.shape
+            or stack[0].dtype != v.dtype
+        ):
+            self._new_stack(k, v)
+        stack, resource_path = self.stacks[k]
+        frame = stack.reserve()
+        self.submit(stack.write_frame, frame, v)
+        return self.root, resource_path, {"frame": frame}
+
+    def close(self):
+        for stack, _ in self.stacks.values():
+            stack.close()
+        for stack in self.closed_stacks:
+            stack.close()
+        self.stacks.clear()
+        self.closed_stacks = []
+
+
+class _MmapCache:
+    """A LRU cache of memory mapped npy files
+
+    Parameters
+    ----------
+    maxsize : int
+        The number of files to keep open
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.maps = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, fpath, min_len=None):
+        """The memory mapped array in a file
+
+        Parameters
+        ----------
+        fpath : str
+            The path to the npy file
+        min_len : int, optional
+            Reopen the file if the cached array is shorter than this (the file
+            has grown)
+
+        Returns
+        -------
+        np.memmap :
+            The read only array
+        """
+        with self.lock:
+            data = self.maps.get(fpath)
+            if data is None or (min_len and len(data) < min_len):
+                data = np.load(fpath, mmap_mode="r")
+                self.maps[fpath] = data
+            self.maps.move_to_end(fpath)
+            while len(self.maps) > self.maxsize:
+                self.maps.popitem(last=False)
+            return data
+
+    def clear(self):
+        with self.lock:
+            self.maps.clear()
+
+
+# shared by the handlers so files are not reopened for every resource
+mmap_cache = _MmapCache()
+
+
+class NpyHandler:
+    """Read the files written by ``NpyWriter``
+
+    The files are memory mapped (and kept open in ``mmap_cache``) so only the
+    parts of the array which are used are read. The arrays are read only.
+    """
+
+    specs = {NpyWriter.spec}
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+
+    def __call__(self):
+        return mmap_cache.get(self.fpath)
+
+    def get_file_list(self, datum_kwarg_gen):
+        return [self.fpath]
+
+
+class NpyStackHandler:
+    """Read frames from the files written by ``StackedNpyWriter``
+
+    The files are memory mapped (and kept open in ``mmap_cache``) so only the
+    frames which are used are read. The frames are read only.
+    """
+
+    specs = {StackedNpyWriter.spec}
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+
+    def __call__(self, frame):
+        # the file may have grown since it was opened
+        return mmap_cache.get(self.fpath, frame + 1)[frame]
+
+    def get_file_list(self, datum_kwarg_gen):
+        return [self.fpath]
+
+
+handler_registry = {
+    NpyWriter.spec: NpyHandler,
+    StackedNpyWriter.spec: NpyStackHandler,
+}